@@ -0,0 +1,80 @@
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from pathlib import Path
+import os
+import numpy as np
+
+from constellation import DEFAULT_CONFIG
+
+ARTIFACT_DIR = "artifacts"
+# Bump when the DSP chain changes what the same config produces
+FINGERPRINT_VERSION = 1
+
+
+@dataclass
+class Artifact:
+    """
+    processAudiofile output of one source file, addresses already encoded with the
+    config's codec and couples with encodeCouple64Bit.
+    """
+
+    toneId: int
+    name: str
+    addresses: np.ndarray
+    couples: np.ndarray
+
+
+def fileHash(filename):
+    # Hash of the source bytes, so a cache hit needs no ffmpeg decode
+    digest = sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def configVersion(config):
+    config = asdict(config or DEFAULT_CONFIG)
+    key = f"{FINGERPRINT_VERSION}:{sorted(config.items())}"
+    return sha256(key.encode()).hexdigest()[:16]
+
+
+def artifactPath(folder, filename, config):
+    return Path(folder) / configVersion(config) / f"{fileHash(filename)}.npz"
+
+
+def readArtifact(folder, filename, config):
+    if folder is None:
+        return None
+    path = artifactPath(folder, filename, config)
+    if not path.exists():
+        return None
+    return loadArtifact(path)
+
+
+def loadArtifact(path):
+    with np.load(path) as f:
+        return Artifact(int(f["toneId"]), str(f["name"]), f["addresses"], f["couples"])
+
+
+def writeArtifact(folder, filename, config, artifact):
+    if folder is None:
+        return
+    path = artifactPath(folder, filename, config)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Written aside and renamed, so a concurrent reader never sees half a file
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(
+            f,
+            toneId=np.int64(artifact.toneId),
+            name=np.str_(artifact.name),
+            addresses=np.asarray(artifact.addresses, dtype=np.int64),
+            couples=np.asarray(artifact.couples, dtype=np.int64),
+        )
+    os.replace(tmp, path)
+
+
+def listArtifacts(folder, config):
+    return sorted((Path(folder) / configVersion(config)).glob("*.npz"))
@@ -54,6 +54,9 @@ BITS_PER_SAMPLE_SIZE = 2
 DATA_DESCR_SIZE = 4
 DATA_CHUNK_SIZE = 4
 
+# Lowpass applied before decimating, streaming uses the same filter
+LOWPASS_HZ = 5000
+
 
 @dataclass
 class Iterator:
@@ -211,7 +214,7 @@ def downsample(info: WAVInfo, factor: int, verbose=False) -> WAVInfo:
 
     # Apply lowpass filter before downsampling
     # cutoff = newSampleFreq / 2
-    info = lowpassFilter(info, 5000)
+    info = lowpassFilter(info, LOWPASS_HZ)
 
     if verbose:
         print(f"Downsampling by factor of {factor}...")
@@ -7,19 +7,30 @@ from hashlib import sha256
 import ffmpeg
 from visualize import visualizeStrongestFrequencies, visualizeSong, visualizeSpectograph
 from codec import decodeAddress32Bit, decodeCouple64Bit
+from constellation import DEFAULT_CONFIG, isConstellation, pairPeaks, pickPeaks
+from profiling import stage
 from audio_proc import WAVInfo, getWAVInfo, generateSpectograph, preprocess
 
 
-def getAudioInfo(filename: str) -> WAVInfo:
+def getAudioInfo(filename: str, start=None, duration=None) -> WAVInfo:
     # if filename.endswith(".wav"):
     #     with open(filename, mode="rb") as f:
     #         return getWAVInfo(f.read())
+
+    # Input side -ss/-t so ffmpeg seeks instead of decoding and discarding
+    inputArgs = {}
+    if start:
+        inputArgs["ss"] = start
+    if duration:
+        inputArgs["t"] = duration
+
     try:
-        process = (
-            ffmpeg.input(filename)
-            .output("pipe:", format="wav")
-            .run(capture_stdout=True, capture_stderr=True)
-        )
+        with stage("decode"):
+            process = (
+                ffmpeg.input(filename, **inputArgs)
+                .output("pipe:", format="wav")
+                .run(capture_stdout=True, capture_stderr=True)
+            )
     except ffmpeg.Error as e:
         print("stdout:", e.stdout.decode("utf8"))
         print("stderr:", e.stderr.decode("utf8"))
@@ -27,6 +38,41 @@ def getAudioInfo(filename: str) -> WAVInfo:
     return getWAVInfo(process[0])
 
 
+def getAudioDuration(filename: str) -> float:
+    return float(ffmpeg.probe(filename)["format"]["duration"])
+
+
+def decodeStream(filename: str, chunkSeconds=5):
+    # One ffmpeg decode as raw 16-bit PCM, returns the sample rate, the channel
+    # count and a generator of chunks holding chunkSeconds of audio each
+    audio = next(
+        s for s in ffmpeg.probe(filename)["streams"] if s["codec_type"] == "audio"
+    )
+    sampleFreq = int(audio["sample_rate"])
+    channels = int(audio["channels"])
+    chunkBytes = int(chunkSeconds * sampleFreq) * channels * 2
+
+    process = (
+        ffmpeg.input(filename)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", loglevel="error")
+        .run_async(pipe_stdout=True)
+    )
+
+    def chunks():
+        try:
+            while True:
+                with stage("decode"):
+                    chunk = process.stdout.read(chunkBytes)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    return sampleFreq, channels, chunks()
+
+
 def playWav(info: WAVInfo):
     print("Playing audio (CTRL-C to stop)")
     sound = pyaudio.PyAudio()
@@ -90,9 +136,14 @@ def quantizeFreqs(freqs, resolution_hz=1):
     return np.power(2, quant_cents / 1200)
 
 
-def extractFrequencies(Zxx, freq, coef=0.5, bands=6, verbose=False):
-    binsN = len(Zxx[0])
+def extractFrequencies(
+    Zxx, freq, coef=0.5, bands=6, verbose=False, nBins=None, edges=None
+):
+    binsN = len(Zxx[0]) if nBins is None else nBins
     ranges = logarithmicSplits(binsN, bands)
+    if edges is not None:
+        bands = len(edges) - 1
+        ranges = [(start, min(end, binsN - 1)) for start, end in zip(edges, edges[1:])]
 
     freqs = []
     for bin in Zxx.T:  # Transpose Zxx to iterate over time bins
@@ -198,34 +249,67 @@ def parseAddressCouple(addressCouple):
         yield addressDecoded, coupleDecoded
 
 
+def audioHash(info):
+    return sha256(info.data).digest()
+
+
 def genToneId(info):
-    hash = sha256(info.data).digest()
+    hash = audioHash(info)
     return int.from_bytes(hash[:4], "big")
 
 
 def processAudiofile(
-    info: WAVInfo, db, toneId, visualize=False, verbose=False, targetRes=50
+    info: WAVInfo,
+    db,
+    toneId,
+    visualize=False,
+    verbose=False,
+    targetRes=None,
+    config=None,
 ):
     if visualize:
         visualizeSong(info)
 
-    info = preprocess(info, downmix=True, downsampleFactor=4, verbose=verbose)
+    config = config or DEFAULT_CONFIG
+    if targetRes is None:
+        targetRes = config.targetRes
+
+    with stage("preprocess"):
+        info = preprocess(
+            info,
+            downmix=True,
+            downsampleFactor=config.downsampleFactor,
+            verbose=verbose,
+        )
     windowSize = int(info.sampleFreq / targetRes)
     windowDuration = windowSize / info.sampleFreq
-    freq, times, Zxx, data, overlap = generateSpectograph(info, windowDuration)
+    with stage("spectrogram"):
+        freq, times, Zxx, data, overlap = generateSpectograph(info, windowDuration)
 
     if visualize:
         visualizeSpectograph(
             freq, times, Zxx, data, overlap, windowSize, info.sampleFreq
         )
 
-    strongest = extractFrequencies(Zxx, freq, verbose=verbose)
-    t = []
-    for timeIdx, freqComp in enumerate(strongest):
-        time = times[timeIdx]
-        for freq in freqComp:
-            if freq > 0:
-                t.append((freq, time))
+    if isConstellation(config):
+        with stage("peaks"):
+            peaks = pickPeaks(freq, times, Zxx, config)
+        with stage("addresses"):
+            addressCouple = pairPeaks(peaks, toneId, config)
+        if verbose:
+            print(f"Number of peaks: {len(peaks)}, pairs: {len(addressCouple)}")
+        return addressCouple
+
+    with stage("peaks"):
+        strongest = extractFrequencies(
+            Zxx, freq, coef=config.bandCoef, verbose=verbose, edges=config.bandEdges
+        )
+        t = []
+        for timeIdx, freqComp in enumerate(strongest):
+            time = times[timeIdx]
+            for freq in freqComp:
+                if freq > 0:
+                    t.append((freq, time))
 
     table = np.asarray(t)
     times = table[:, 1]
@@ -235,9 +319,10 @@ def processAudiofile(
         visualizeStrongestFrequencies(times, freqs)
         plt.show()
 
-    orderedFreqs = generateTimeFreqOrderRelation(times, freqs)
-    targetZones = createTargetZones(orderedFreqs)
-    addressCouple = generateAddress(targetZones, orderedFreqs, times, toneId)
+    with stage("addresses"):
+        orderedFreqs = generateTimeFreqOrderRelation(times, freqs)
+        targetZones = createTargetZones(orderedFreqs)
+        addressCouple = generateAddress(targetZones, orderedFreqs, times, toneId)
 
     if verbose:
         print(f"Number of target zones: {len(targetZones)}")
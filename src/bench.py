@@ -0,0 +1,283 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+from multiprocessing import get_context
+import json
+import platform
+import resource
+import subprocess
+import time
+import wave
+import numpy as np
+
+from constellation import DEFAULT_CONFIG, PICKERS, FingerprintConfig
+from db_utils import compactPostings, createDatabase
+from scan import scanFile
+from stopwords import postingListStats
+from search_load import (
+    loadFile,
+    searchFile,
+    searchFileProgressive,
+    searchFileSQL,
+)
+
+SAMPLE_FREQ = 44100
+TONE_SECONDS = 20
+QUERY_SECONDS = 5
+CATALOG_SIZES = [10, 50, 100]
+QUERIES_PER_SIZE = 20
+QUERY_KINDS = ["clean", "noisy", "shifted"]
+# Catalog tones played back to back in the scan recording
+SCAN_TONES = 5
+# Noise level of noisy queries relative to the excerpt RMS
+NOISE_RATIO = 0.3
+
+SCHEMA_PATH = str(Path(__file__).parent / "db" / "schema.sql")
+
+SEARCHES = {
+    "search": searchFile,
+    "search_sql": searchFileSQL,
+    "search_progressive": searchFileProgressive,
+}
+
+
+def writeWav(path, samples):
+    # Stereo 16-bit PCM, samples are floats in [-1, 1]
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_FREQ)
+        f.writeframes(np.repeat(pcm, 2).tobytes())
+
+
+def note(rng, freqs, seconds):
+    t = np.arange(int(seconds * SAMPLE_FREQ)) / SAMPLE_FREQ
+    envelope = np.exp(-t * rng.uniform(1, 6)) * np.minimum(1, t * 200)
+    return envelope * sum(np.sin(2 * np.pi * f * t) for f in freqs) / len(freqs)
+
+
+def synthesize(rng, chords, seconds=TONE_SECONDS):
+    # A melody of equal-tempered notes, or three note chords, of random lengths
+    parts = []
+    total = 0
+    while total < seconds:
+        length = rng.uniform(0.15, 0.6)
+        root = 110 * 2 ** (rng.integers(0, 48) / 12)
+        freqs = [root * 2 ** (i / 12) for i in (0, 4, 7)] if chords else [root]
+        parts.append(note(rng, freqs, length))
+        total += length
+    return 0.8 * np.concatenate(parts)[: int(seconds * SAMPLE_FREQ)]
+
+
+def excerpt(rng, samples, kind, seconds=QUERY_SECONDS):
+    start = rng.integers(0, len(samples) - int(seconds * SAMPLE_FREQ))
+    if kind == "shifted":
+        # Off the STFT grid by a fraction of a window, at a different gain
+        start += rng.integers(1, 64)
+    cut = samples[start : start + int(seconds * SAMPLE_FREQ)]
+    if kind == "shifted":
+        cut = cut * rng.uniform(0.5, 0.9)
+    if kind == "noisy":
+        rms = np.sqrt(np.mean(cut**2))
+        cut = cut + rng.normal(0, NOISE_RATIO * rms, len(cut))
+    return cut
+
+
+def generateCorpus(folder: Path, numTones, numQueries, seed=0):
+    # Same seed, same bytes. Returns the tone paths and (query path, tone name) pairs
+    rng = np.random.default_rng(seed)
+    (folder / "tones").mkdir(parents=True, exist_ok=True)
+    (folder / "queries").mkdir(parents=True, exist_ok=True)
+
+    tones = []
+    queries = []
+    for i in range(numTones):
+        samples = synthesize(rng, chords=i % 2 == 1)
+        path = folder / "tones" / f"{'chord' if i % 2 else 'tone'}_{i:05d}.wav"
+        writeWav(path, samples)
+        tones.append(path)
+
+        if i < numQueries:
+            kind = QUERY_KINDS[i % len(QUERY_KINDS)]
+            query = folder / "queries" / f"{path.stem}_{kind}.wav"
+            writeWav(query, excerpt(rng, samples, kind))
+            queries.append((query, path.stem))
+    return tones, queries
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": p50, "p90": p90, "p99": p99, "max": max(values)}
+
+
+def peakRssKb():
+    # VmHWM rather than ru_maxrss, which Linux carries over fork and exec so even a
+    # fresh process reports its parent's peak. ffmpeg children only have ru_maxrss,
+    # which can read as high as this process was when they were forked
+    with open("/proc/self/status") as f:
+        own = next(int(line.split()[1]) for line in f if line.startswith("VmHWM"))
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": own, "children": children}
+
+
+def isHit(res, expected):
+    if res is None:
+        return False
+    if isinstance(res, (tuple, list)):
+        return len(res) > 0 and res[0][0] == expected
+    return res == expected
+
+
+def benchIngest(db, tones, bloomPath, config=None, stopPolicy=None):
+    start = time.perf_counter()
+    for tone in tones:
+        loadFile(
+            db, str(tone), bloomPath=bloomPath, stopPolicy=stopPolicy, config=config
+        )
+    compactPostings(db)
+    seconds = time.perf_counter() - start
+    postings = postingListStats(db)["postings"]
+    return {
+        "files": len(tones),
+        "seconds": seconds,
+        "filesPerSecond": len(tones) / seconds,
+        "fingerprints": postings,
+        "fingerprintsPerSecond": postings / seconds,
+    }
+
+
+def benchQueries(db, queries, modes, config=None, **params):
+    results = {}
+    for mode in modes:
+        latencies = []
+        hits = 0
+        for query, expected in queries:
+            start = time.perf_counter()
+            res = SEARCHES[mode](db, str(query), config=config, **params)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += isHit(res, expected)
+        results[mode] = {
+            "queries": len(queries),
+            "accuracy": hits / len(queries) if queries else 0,
+            "latencyMs": percentiles(latencies),
+        }
+    return results
+
+
+def writeRecording(path, tones):
+    parts = []
+    for tone in tones:
+        with wave.open(str(tone)) as f:
+            pcm = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+        parts.append(pcm[::2] / 32767)
+    writeWav(path, np.concatenate(parts))
+
+
+def benchScan(db, folder: Path, tones, config=None):
+    # realtimeFactor is seconds of recording scanned per second of wall time
+    path = folder / "scan.wav"
+    writeRecording(path, tones)
+    stats = {}
+    segments = scanFile(db, str(path), config=config, stats=stats)
+    found = {tone for tone, *_ in segments} & {tone.stem for tone in tones}
+    return {
+        "tones": len(tones),
+        "found": len(found) / len(tones),
+        "segments": len(segments),
+        **stats,
+    }
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchSize(db, folder: Path, size, tones, queries, modes, bloomPath, config=None):
+    # Every size starts from an empty database and bloom filter
+    createDatabase(db, SCHEMA_PATH)
+    Path(bloomPath).unlink(missing_ok=True)
+
+    ingest = benchIngest(db, tones[:size], bloomPath, config)
+    inCatalog = [(q, name) for q, name in queries if int(name[-5:]) < size]
+    return {
+        "catalogSize": size,
+        "ingest": ingest,
+        "search": benchQueries(db, inCatalog, modes, config),
+        "scan": benchScan(db, folder, tones[: min(size, SCAN_TONES)], config),
+        "peakRssKb": peakRssKb(),
+    }
+
+
+def runBenchmarks(
+    db,
+    folder: Path,
+    sizes=CATALOG_SIZES,
+    numQueries=QUERIES_PER_SIZE,
+    modes=None,
+    seed=0,
+    config=None,
+):
+    modes = modes or list(SEARCHES)
+    tones, queries = generateCorpus(folder, max(sizes), numQueries, seed)
+    bloomPath = str(folder / "bench.bloom")
+
+    runs = []
+    for size in sorted(sizes):
+        # ru_maxrss never goes down, a fresh process per size keeps the peaks apart
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            run = executor.submit(
+                benchSize, db, folder, size, tones, queries, modes, bloomPath, config
+            ).result()
+        runs.append(run)
+        print(f"{size} tones: {run['ingest']['filesPerSecond']:.2f} files/s")
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "seed": seed,
+        "config": asdict(config or DEFAULT_CONFIG),
+        "runs": runs,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="bench", description="Ingest and search benchmarks on a synthetic corpus"
+    )
+    parser.add_argument(
+        "--db",
+        default="dbname=tones_bench user=mads",
+        help="Database to benchmark, its tables are dropped and recreated",
+    )
+    parser.add_argument("--corpus", default="bench_corpus", help="Corpus folder")
+    parser.add_argument("--output", default="bench_results.json", help="Results file")
+    parser.add_argument("--sizes", default=CATALOG_SIZES, type=int, nargs="+")
+    parser.add_argument("--queries", default=QUERIES_PER_SIZE, type=int)
+    parser.add_argument("--modes", default=list(SEARCHES), nargs="+", choices=SEARCHES)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--picker", default="bands", choices=PICKERS)
+    args = parser.parse_args()
+
+    results = runBenchmarks(
+        args.db,
+        Path(args.corpus),
+        args.sizes,
+        args.queries,
+        args.modes,
+        args.seed,
+        FingerprintConfig(picker=args.picker),
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
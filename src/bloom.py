@@ -0,0 +1,142 @@
+from contextlib import contextmanager
+import fcntl
+import mmap
+import os
+from math import ceil, log
+import numpy as np
+
+# Kept next to the database so ingest and search processes share it
+BLOOM_PATH = "tones.bloom"
+FALSE_POSITIVE_RATE = 0.01
+# Room for the catalog to grow before the false positive rate drifts
+GROWTH = 2
+
+MAGIC = b"TNBF"
+HEADER = np.dtype([("numBits", "<u8"), ("numHashes", "<u8"), ("count", "<u8")])
+
+
+def mix64(x):
+    # splitmix64 finalizer, wraps on purpose
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class BloomFilter:
+    def __init__(self, numBits, numHashes, bits=None, count=0):
+        self.numBits = int(numBits)
+        self.numHashes = int(numHashes)
+        self.bits = (
+            np.zeros((self.numBits + 7) // 8, dtype=np.uint8) if bits is None else bits
+        )
+        self.count = count
+
+    @classmethod
+    def sized(cls, capacity, fpRate=FALSE_POSITIVE_RATE):
+        capacity = max(int(capacity), 1)
+        numBits = ceil(-capacity * log(fpRate) / log(2) ** 2)
+        numHashes = max(1, round(numBits / capacity * log(2)))
+        return cls(numBits, numHashes)
+
+    def _positions(self, addresses):
+        addresses = np.asarray(addresses, dtype=np.int64).astype(np.uint64)
+        h1 = mix64(addresses)
+        h2 = mix64(addresses ^ np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+        i = np.arange(self.numHashes, dtype=np.uint64)
+        return (h1[:, None] + i * h2[:, None]) % np.uint64(self.numBits)
+
+    def add(self, addresses):
+        pos = self._positions(addresses).ravel()
+        np.bitwise_or.at(self.bits, pos >> np.uint64(3), 1 << (pos & np.uint64(7)))
+        self.count += len(addresses)
+
+    def contains(self, addresses):
+        pos = self._positions(addresses)
+        hit = self.bits[pos >> np.uint64(3)] & (1 << (pos & np.uint64(7))).astype(
+            np.uint8
+        )
+        return hit.all(axis=1)
+
+    def save(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.array([(self.numBits, self.numHashes, self.count)], HEADER))
+            f.write(self.bits.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a bloom filter")
+            header = np.frombuffer(f.read(HEADER.itemsize), HEADER)[0]
+            bits = np.frombuffer(f.read(), dtype=np.uint8).copy()
+        return cls(header["numBits"], header["numHashes"], bits, int(header["count"]))
+
+
+def buildBloomFilter(addresses, path=BLOOM_PATH, fpRate=FALSE_POSITIVE_RATE):
+    addresses = np.unique(np.asarray(addresses, dtype=np.int64))
+    bloom = BloomFilter.sized(len(addresses) * GROWTH, fpRate)
+    bloom.add(addresses)
+    with bloomLock(path):
+        bloom.save(path)
+    return bloom
+
+
+@contextmanager
+def bloomLock(path):
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def addToBloomFile(addresses, path=BLOOM_PATH):
+    # Ingest workers run in separate processes. Each sets the bits of its own addresses
+    # in place through a shared mapping of the file, the lock keeps their byte updates
+    # and the count apart
+    if path is None or not os.path.exists(path) or len(addresses) == 0:
+        return
+    addresses = np.unique(np.asarray(addresses, dtype=np.int64))
+    with bloomLock(path), open(path, "r+b") as f:
+        mapped = mmap.mmap(f.fileno(), 0)
+        try:
+            addToMapped(mapped, addresses, path)
+            mapped.flush()
+        finally:
+            mapped.close()
+    # Writes through a mapping need not move mtime, which getBloomFilter reloads on
+    os.utime(path)
+
+
+def addToMapped(mapped, addresses, path):
+    if mapped[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a bloom filter")
+    header = np.frombuffer(mapped, HEADER, count=1, offset=len(MAGIC))
+    bits = np.frombuffer(mapped, np.uint8, offset=len(MAGIC) + HEADER.itemsize)
+    bloom = BloomFilter(
+        header[0]["numBits"], header[0]["numHashes"], bits, int(header[0]["count"])
+    )
+    # Only addresses the filter rules out are new, so count is not inflated by
+    # addresses stored again under other songs
+    bloom.add(addresses[~bloom.contains(addresses)])
+    header["count"] = bloom.count
+
+
+_loaded = {}
+
+
+def getBloomFilter(path=BLOOM_PATH):
+    """
+    Process wide copy of the filter at path, reloaded when ingest rewrites the file.
+    None when no filter has been built.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    mtime = os.stat(path).st_mtime_ns
+    if path not in _loaded or _loaded[path][0] != mtime:
+        _loaded[path] = (mtime, BloomFilter.load(path))
+    return _loaded[path][1]
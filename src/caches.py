@@ -0,0 +1,251 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from hashlib import sha256
+import time
+import numpy as np
+import db_utils
+
+
+class ToneCache:
+    """
+    toneId -> name lookup for the search path, bulk loaded once with readTones.
+
+    Ids are kept as a sorted uint32 array with the names in matching order, tones
+    stored after the bulk load go to a small overflow dict until the next load.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.ids = None
+        self.names = []
+        self.added = {}
+
+    @property
+    def loaded(self):
+        return self.ids is not None
+
+    def load(self):
+        tones = sorted(
+            (int(toneId), name) for toneId, name in db_utils.readTones(self.db)
+        )
+        self.ids = np.fromiter((toneId for toneId, _ in tones), dtype=np.uint32)
+        self.names = [name for _, name in tones]
+        self.added = {}
+
+    def invalidate(self):
+        self.ids = None
+        self.names = []
+        self.added = {}
+
+    def update(self, toneId, name):
+        if self.loaded:
+            self.added[int(toneId)] = name
+
+    def name(self, toneId):
+        if not self.loaded:
+            self.load()
+
+        toneId = int(toneId)
+        pos = np.searchsorted(self.ids, toneId)
+        if pos < len(self.ids) and self.ids[pos] == toneId:
+            return self.names[pos]
+        if toneId in self.added:
+            return self.added[toneId]
+
+        # Stored by another process since the bulk load
+        tone = db_utils.readTone(self.db, toneId)
+        if tone is None:
+            return None
+        self.added[toneId] = tone[1]
+        return tone[1]
+
+
+_toneCaches = {}
+
+
+def getToneCache(db):
+    if db not in _toneCaches:
+        _toneCaches[db] = ToneCache(db)
+    return _toneCaches[db]
+
+
+# Posting lists are cached as int64 couple arrays, the constant covers the
+# OrderedDict entry and array header
+POSTING_CACHE_BYTES = 256 * 1024 * 1024
+POSTING_ENTRY_OVERHEAD = 200
+# How often a cache asks the database whether another process changed the catalog
+VERSION_CHECK_SECONDS = 1.0
+
+
+class VersionedCache(ABC):
+    """
+    Base for caches that must be dropped when another process changes the catalog,
+    callers pass readCatalogVersion to checkVersion whenever due() says so.
+    """
+
+    def __init__(self, checkInterval=VERSION_CHECK_SECONDS):
+        self.checkInterval = checkInterval
+        self.version = None
+        self.lastCheck = 0.0
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def due(self):
+        return time.monotonic() - self.lastCheck >= self.checkInterval
+
+    def checkVersion(self, version):
+        self.lastCheck = time.monotonic()
+        if self.version is not None and version != self.version:
+            self.clear()
+        self.version = version
+
+
+class PostingCache(VersionedCache):
+    """
+    address -> couples cache for the search path, bounded by bytes with LRU eviction.
+
+    Ingest in this process invalidates the stored addresses directly, ingest in
+    other processes is noticed through the catalog version and clears the cache.
+    """
+
+    def __init__(
+        self, maxBytes=POSTING_CACHE_BYTES, checkInterval=VERSION_CHECK_SECONDS
+    ):
+        super().__init__(checkInterval)
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entrySize(couples):
+        return couples.nbytes + POSTING_ENTRY_OVERHEAD
+
+    def get(self, address):
+        couples = self.entries.get(address)
+        if couples is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(address)
+        self.hits += 1
+        return couples
+
+    def put(self, address, couples):
+        size = self._entrySize(couples)
+        if size > self.maxBytes:
+            return
+        if address in self.entries:
+            self.size -= self._entrySize(self.entries.pop(address))
+        self.entries[address] = couples
+        self.size += size
+        while self.size > self.maxBytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self._entrySize(evicted)
+            self.evictions += 1
+
+    def invalidate(self, addresses):
+        for address in addresses:
+            if address in self.entries:
+                self.size -= self._entrySize(self.entries.pop(address))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+
+_postingCaches = {}
+
+
+def getPostingCache(db, maxBytes=POSTING_CACHE_BYTES):
+    if db not in _postingCaches:
+        _postingCaches[db] = PostingCache(maxBytes)
+    return _postingCaches[db]
+
+
+# Results are small, so the result cache is bounded by entry count and age
+RESULT_CACHE_ENTRIES = 1024
+RESULT_CACHE_TTL = 3600.0
+# Searches can legitimately return None, so misses are reported with this instead
+MISS = object()
+
+
+def resultKey(audioHash, mode, **params):
+    params = repr(sorted(params.items())).encode()
+    return sha256(audioHash + mode.encode() + params).hexdigest()
+
+
+class ResultCache(VersionedCache):
+    """
+    Search results keyed by resultKey over the decoded query PCM and search
+    parameters, with TTL and LRU eviction. Any catalog change clears it.
+    """
+
+    def __init__(
+        self,
+        maxEntries=RESULT_CACHE_ENTRIES,
+        ttl=RESULT_CACHE_TTL,
+        checkInterval=VERSION_CHECK_SECONDS,
+    ):
+        super().__init__(checkInterval)
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return MISS
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+_resultCaches = {}
+
+
+def getResultCache(db, maxEntries=RESULT_CACHE_ENTRIES, ttl=RESULT_CACHE_TTL):
+    if db not in _resultCaches:
+        _resultCaches[db] = ResultCache(maxEntries, ttl)
+    return _resultCaches[db]
+
+
+def onToneStored(toneId, toneName):
+    for cache in _toneCaches.values():
+        cache.update(toneId, toneName)
+    for cache in _resultCaches.values():
+        cache.clear()
+
+
+def onCouplesStored(addresses):
+    for cache in _postingCaches.values():
+        cache.invalidate(addresses)
+    for cache in _resultCaches.values():
+        cache.clear()
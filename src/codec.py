@@ -1,6 +1,67 @@
+from dataclasses import dataclass
 import numpy as np
 
 
+class CodecMismatch(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Codec:
+    """
+    Bit allocation of an address, anchor | freq | delta from the high bits down.
+    Frequencies drop their low freqShift bits and deltas are counted in deltaStepMs
+    steps, clamped to the largest delta the field holds instead of wrapping.
+    Addresses are stored as bigint, so the fields share 63 bits.
+    """
+
+    version: int
+    anchorBits: int = 9
+    freqBits: int = 9
+    deltaBits: int = 14
+    freqShift: int = 0
+    deltaStepMs: int = 1
+
+    def __post_init__(self):
+        if self.anchorBits + self.freqBits + self.deltaBits > 63:
+            raise ValueError(f"Codec {self.version} does not fit a signed bigint")
+
+    def encodeAddress(self, address) -> int:
+        anchor, freq, delta = address
+        anchor = (int(anchor) >> self.freqShift) & ((1 << self.anchorBits) - 1)
+        freq = (int(freq) >> self.freqShift) & ((1 << self.freqBits) - 1)
+        delta = min(int(delta) // self.deltaStepMs, (1 << self.deltaBits) - 1)
+        return (
+            (anchor << (self.freqBits + self.deltaBits))
+            | (freq << self.deltaBits)
+            | delta
+        )
+
+    def decodeAddress(self, encoded):
+        encoded = int(encoded)
+        anchor = (encoded >> (self.freqBits + self.deltaBits)) & (
+            (1 << self.anchorBits) - 1
+        )
+        freq = (encoded >> self.deltaBits) & ((1 << self.freqBits) - 1)
+        delta = encoded & ((1 << self.deltaBits) - 1)
+        return (
+            anchor << self.freqShift,
+            freq << self.freqShift,
+            delta * self.deltaStepMs,
+        )
+
+
+CODECS = {
+    # The original 32-bit layout, deltas clamp at 16 s
+    1: Codec(1),
+    # Deltas up to 17 minutes, the address no longer fits 32 bits
+    2: Codec(2, deltaBits=20),
+    # Coarser addresses: fewer distinct keys, longer posting lists
+    3: Codec(3, anchorBits=8, freqBits=8, deltaBits=10, freqShift=1, deltaStepMs=10),
+}
+DEFAULT_CODEC = CODECS[1]
+
+
 def encodeAddress32Bit(address) -> np.int32:
     anchor, freq, delta = address
     delta = int(delta)
@@ -25,3 +86,29 @@ def decodeCouple64Bit(encoded):
     anchorTime = (int(encoded) >> 32) & 0xFFFFFFFF
     songId = int(encoded) & 0xFFFFFFFF
     return anchorTime, songId
+
+
+# array_send of a 1-D bigint[]: ndim, flags, element oid, length, lower bound, then
+# a 4 byte length ahead of every 8 byte element, all big-endian
+ARRAY_HEADER_BYTES = 20
+ARRAY_HEADER = np.dtype(
+    [(key, ">i4") for key in ["ndim", "flags", "oid", "n", "lower"]]
+)
+PACKED_COUPLE = np.dtype([("length", ">i4"), ("couple", ">i8")])
+INT8_OID = 20
+
+
+def unpackCouples(packed) -> np.ndarray:
+    if len(packed) <= ARRAY_HEADER_BYTES:
+        return np.zeros(0, dtype=np.int64)
+    couples = np.frombuffer(packed, dtype=PACKED_COUPLE, offset=ARRAY_HEADER_BYTES)
+    return couples["couple"].astype(np.int64)
+
+
+def packCouples(couples) -> bytes:
+    # Inverse of unpackCouples, also the binary COPY form of a bigint[]
+    header = np.array([(1, 0, INT8_OID, len(couples), 1)], dtype=ARRAY_HEADER)
+    packed = np.empty(len(couples), dtype=PACKED_COUPLE)
+    packed["length"] = 8
+    packed["couple"] = couples
+    return header.tobytes() + packed.tobytes()
@@ -0,0 +1,127 @@
+from dataclasses import asdict, dataclass
+import json
+import numpy as np
+from scipy.ndimage import maximum_filter, uniform_filter1d
+
+from codec import CODECS
+
+PICKERS = ["bands", "constellation"]
+
+# Peaks kept per second of audio and targets paired with every anchor
+PEAKS_PER_SECOND = 20
+FAN_OUT = 3
+
+# STFT bin ranges the bands picker takes a maximum from, as in logarithmicSplits
+BAND_EDGES = (0, 10, 20, 40, 80, 160, 511)
+
+
+@dataclass(frozen=True)
+class FingerprintConfig:
+    """
+    How audio becomes fingerprints. The spectrogram has targetRes windows per second
+    after decimating by downsampleFactor. bands is the original picker, the
+    maximum of every band in bandEdges per frame if it beats bandCoef times the
+    frame's average. constellation keeps 2D local maxima over +-neighborhoodMs and
+    +-neighborhoodBins STFT bins that beat their bin's average over thresholdMs,
+    at most peaksPerSecond per second, and pairs each anchor with the first fanOut
+    peaks in its target zone. zoneFreq is in quantizeFreq9Bit steps, about 51 to
+    the octave. codec is the CODECS version addresses are encoded with. Load and
+    search must use the same config.
+    """
+
+    targetRes: float = 200
+    downsampleFactor: int = 4
+    picker: str = "bands"
+    bandCoef: float = 0.5
+    bandEdges: tuple = BAND_EDGES
+    peaksPerSecond: int = PEAKS_PER_SECOND
+    fanOut: int = FAN_OUT
+    neighborhoodMs: int = 50
+    neighborhoodBins: int = 2
+    thresholdMs: int = 1000
+    zoneStartMs: int = 10
+    zoneEndMs: int = 1000
+    zoneFreq: int = 64
+    codec: int = 1
+
+
+DEFAULT_CONFIG = FingerprintConfig()
+
+
+class ConfigMismatch(ValueError):
+    pass
+
+
+def matchConfig(found, config, where="Database"):
+    # found is the JSON config stored with the fingerprints, None when unknown
+    if found is None:
+        return
+    found = json.loads(found)
+    expected = json.loads(json.dumps(asdict(config or DEFAULT_CONFIG)))
+    differ = sorted(
+        k for k in found.keys() | expected.keys() if found.get(k) != expected.get(k)
+    )
+    if differ:
+        raise ConfigMismatch(
+            f"{where} was loaded with "
+            + ", ".join(f"{k}={found.get(k)}" for k in differ)
+            + ", not "
+            + ", ".join(f"{k}={expected.get(k)}" for k in differ)
+        )
+
+
+def isConstellation(config):
+    return config is not None and config.picker == "constellation"
+
+
+def configCodec(config):
+    return CODECS[(config or DEFAULT_CONFIG).codec]
+
+
+def pickPeaks(freq, times, Zxx, config=DEFAULT_CONFIG):
+    # Returns (time ms, freq) peaks sorted by time
+    if Zxx.shape[1] < 2:
+        return []
+
+    frameMs = max(1, times[1] - times[0])
+    timeSize = 2 * max(1, int(config.neighborhoodMs / frameMs)) + 1
+    freqSize = 2 * config.neighborhoodBins + 1
+
+    spectrum = np.log1p(Zxx)
+    spectrum[0] = 0  # DC carries no pitch
+    local = maximum_filter(spectrum, size=(freqSize, timeSize), mode="constant")
+    threshold = uniform_filter1d(
+        spectrum, size=max(1, int(config.thresholdMs / frameMs)), axis=1
+    )
+    bins, frames = np.nonzero((spectrum == local) & (spectrum > threshold))
+    strength = spectrum[bins, frames] - threshold[bins, frames]
+
+    # Strongest peaks first within each second, then keep the budget of every second
+    seconds = times[frames] // 1000
+    order = np.lexsort((-strength, seconds))
+    bins, frames, seconds = bins[order], frames[order], seconds[order]
+    firstOfSecond = np.searchsorted(seconds, seconds)
+    keep = np.arange(len(seconds)) - firstOfSecond < config.peaksPerSecond
+
+    peaks = sorted(zip(times[frames[keep]], freq[bins[keep]]))
+    return [(int(t), f) for t, f in peaks]
+
+
+def pairPeaks(peaks, songId, config=DEFAULT_CONFIG):
+    # Same (anchor, freq, delta), (anchorTime, songId) pairs as generateAddress
+    peakTimes = np.array([t for t, _ in peaks], dtype=np.int64)
+    addressCouple = []
+    for i, (anchorTime, anchor) in enumerate(peaks):
+        start = np.searchsorted(peakTimes, anchorTime + config.zoneStartMs)
+        end = np.searchsorted(peakTimes, anchorTime + config.zoneEndMs, "right")
+        paired = 0
+        for freqTime, freq in peaks[max(start, i + 1) : end]:
+            if paired == config.fanOut:
+                break
+            if abs(int(freq) - int(anchor)) > config.zoneFreq:
+                continue
+            addressCouple.append(
+                ((anchor, freq, freqTime - anchorTime), (anchorTime, songId))
+            )
+            paired += 1
+    return addressCouple
@@ -3,6 +3,18 @@ drop table if exists address_couple;
 
 drop table if exists tone;
 
+drop table if exists stop_address;
+
+drop table if exists posting;
+
+drop table if exists meta;
+
 create table if not exists address_couple (address bigint, couple bigint);
 
 create table if not exists tone (toneId bigint primary key, name character varying);
+
+create table if not exists stop_address (address bigint primary key, df bigint, postings bigint);
+
+create table if not exists posting (address bigint primary key, couples bigint[]);
+
+create table if not exists meta (key character varying primary key, value character varying);
@@ -1,9 +1,29 @@
 # import sqlite3 as sql
+from dataclasses import asdict
+import json
+import struct
+import numpy as np
 import psycopg as sql
-from codec import encodeAddress32Bit, encodeCouple64Bit
+import caches
+from bloom import BLOOM_PATH, addToBloomFile
+from codec import (
+    CODECS,
+    DEFAULT_CODEC,
+    CodecMismatch,
+    encodeCouple64Bit,
+    packCouples,
+)
+from constellation import DEFAULT_CONFIG, configCodec, matchConfig
 
 TIMEOUT = 50
 
+# New couples are appended to address_couple, compaction moves them into one posting
+# row per address. Readers see both, this is every stored couple
+ALL_COUPLES = """
+(SELECT address, couple FROM address_couple
+    UNION ALL SELECT address, unnest(couples) AS couple FROM posting)
+"""
+
 
 def createDatabase(db, schema):
     with sql.connect(db) as conn:
@@ -17,6 +37,18 @@ def createDatabase(db, schema):
         conn.commit()
 
 
+def createSchema(db, schema):
+    # Tables created through a connection with search_path=schema land in it
+    with sql.connect(db) as conn:
+        conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    return f"{db} options='-c search_path={schema}'"
+
+
+def dropSchema(db, schema):
+    with sql.connect(db) as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+
+
 def storeTone(conn, toneId, toneName, verbose=True):
     print(f"Storing tone {toneId} with name {toneName}")
     with conn.cursor() as cursor:
@@ -32,6 +64,7 @@ def storeTone(conn, toneId, toneName, verbose=True):
             # return
 
     conn.commit()
+    caches.onToneStored(toneId, toneName)
 
 
 # def storeTone(db, toneId, toneName, verbose=True):
@@ -52,18 +85,40 @@ def storeTone(conn, toneId, toneName, verbose=True):
 #         conn.commit()
 
 
-def storeAddressCouple(conn, addressCouple):
+def storeAddressCouple(
+    conn,
+    addressCouple,
+    bloomPath=BLOOM_PATH,
+    stopAddresses=None,
+    codec=DEFAULT_CODEC,
+):
+    storeEncodedCouples(
+        conn,
+        [codec.encodeAddress(address) for address, _ in addressCouple],
+        [encodeCouple64Bit(couple) for _, couple in addressCouple],
+        bloomPath=bloomPath,
+        stopAddresses=stopAddresses,
+    )
+
+
+def storeEncodedCouples(
+    conn, addresses, couples, bloomPath=BLOOM_PATH, stopAddresses=None
+):
+    stored = []
     with conn.cursor() as cursor:
-        for address, couple in addressCouple:
-            try:
-                cursor.execute(
-                    "INSERT INTO address_couple (address, couple) VALUES (%s, %s)",
-                    (encodeAddress32Bit(address), encodeCouple64Bit(couple)),
-                )
-            except sql.errors.UniqueViolation:
-                continue
+        with cursor.copy("COPY address_couple (address, couple) FROM STDIN") as copy:
+            for address, couple in zip(addresses, couples):
+                address = int(address)
+                # Stop addresses already match too many songs to be worth growing
+                if stopAddresses and address in stopAddresses:
+                    continue
+                copy.write_row((address, int(couple)))
+                stored.append(address)
+        bumpCatalogVersion(cursor)
 
         conn.commit()
+    addToBloomFile(stored, bloomPath)
+    caches.onCouplesStored(stored)
 
 
 # def storeAddressCouple(db, addressCouple):
@@ -102,6 +157,35 @@ def readAllAddressCouple(db):
             return cursor.fetchall()
 
 
+def compactPostings(db):
+    # Folds the appended couples into the packed posting rows, loads running at the
+    # same time keep appending and are picked up by the next compaction
+    with sql.connect(db) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                WITH moved AS (DELETE FROM address_couple RETURNING address, couple)
+                INSERT INTO posting (address, couples)
+                SELECT address, array_agg(couple ORDER BY couple) FROM moved
+                GROUP BY address
+                ON CONFLICT (address) DO UPDATE SET couples = ARRAY(
+                    SELECT unnest(posting.couples || excluded.couples) ORDER BY 1
+                )
+                """)
+            compacted = cursor.rowcount
+            bumpCatalogVersion(cursor)
+        conn.commit()
+    return compacted
+
+
+def readDistinctAddresses(db):
+    with sql.connect(db) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT address FROM address_couple UNION SELECT address FROM posting"
+            )
+            return [address for (address,) in cursor.fetchall()]
+
+
 def readAddressCoupleFromAddress(db, address):
     with sql.connect(db) as conn:
         with conn.cursor() as cursor:
@@ -121,3 +205,415 @@ def readTones(db):
         with conn.cursor() as cursor:
             cursor.execute("SELECT * FROM tone")
             return cursor.fetchall()
+
+
+# Databases created before the meta table were all written with the first codec and
+# the default fingerprint settings
+LEGACY_META = {
+    "codec": json.dumps(asdict(CODECS[1]), sort_keys=True),
+    "config": json.dumps(asdict(DEFAULT_CONFIG), sort_keys=True),
+}
+
+
+def readMeta(conn, key):
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("SELECT value FROM meta WHERE key = %s", [key])
+        except sql.errors.UndefinedTable:
+            conn.rollback()
+            return LEGACY_META.get(key)
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+
+def createMeta(cursor):
+    # Adds the meta table to a database from before it, claimed by the legacy codec
+    cursor.execute("SELECT to_regclass('meta')")
+    if cursor.fetchone()[0] is None:
+        cursor.execute(
+            "create table if not exists meta (key character varying primary key, value character varying)"
+        )
+        cursor.executemany(
+            "INSERT INTO meta (key, value) VALUES (%s, %s)",
+            list(LEGACY_META.items()),
+        )
+
+
+def migrateMeta(conn):
+    with conn.cursor() as cursor:
+        createMeta(cursor)
+    conn.commit()
+
+
+def bumpCatalogVersion(cursor):
+    # Part of every transaction that writes postings or the stop list. A fresh random
+    # value rather than a counter, so a recreated database never comes back to a
+    # version a running process has already seen
+    createMeta(cursor)
+    cursor.execute("""
+        INSERT INTO meta (key, value)
+        VALUES ('catalog_version', md5(random()::text || clock_timestamp()::text))
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        """)
+
+
+def checkCodec(conn, codec, store=False):
+    # A database is written with one codec, store claims it for an empty database
+    expected = json.dumps(asdict(codec), sort_keys=True)
+    if store:
+        migrateMeta(conn)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO meta (key, value) VALUES ('codec', %s) ON CONFLICT DO NOTHING",
+                [expected],
+            )
+        conn.commit()
+
+    found = readMeta(conn, "codec")
+    if found is not None and json.loads(found) != asdict(codec):
+        raise CodecMismatch(
+            f"Database uses codec {json.loads(found)['version']}, not {codec.version}"
+        )
+
+
+def checkConfig(conn, config, store=False):
+    # Fingerprints only match fingerprints made with the same settings, the codec is
+    # checked first for its clearer message
+    config = config or DEFAULT_CONFIG
+    checkCodec(conn, configCodec(config), store)
+    expected = json.dumps(asdict(config), sort_keys=True)
+    if store:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO meta (key, value) VALUES ('config', %s) ON CONFLICT DO NOTHING",
+                [expected],
+            )
+        conn.commit()
+
+    matchConfig(readMeta(conn, "config"), config)
+
+
+def readCatalogVersion(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT count(*), coalesce(sum(toneId), 0) FROM tone")
+        tones = tuple(cursor.fetchone())
+    return tones + (readMeta(conn, "catalog_version"),)
+
+
+async def readCatalogVersionAsync(conn):
+    async with conn.cursor() as cursor:
+        await cursor.execute("SELECT count(*), coalesce(sum(toneId), 0) FROM tone")
+        tones = tuple(await cursor.fetchone())
+        try:
+            await cursor.execute("SELECT value FROM meta WHERE key = 'catalog_version'")
+        except sql.errors.UndefinedTable:
+            await conn.rollback()
+            return tones + (None,)
+        row = await cursor.fetchone()
+    return tones + (None if row is None else row[0],)
+
+
+async def readAddressCouplesPipelined(conn, addresses, cap=None):
+    query = """
+    SELECT address, couple FROM address_couple WHERE address = %(address)s
+    UNION ALL SELECT address, unnest(couples) FROM posting WHERE address = %(address)s
+    """
+    if cap is not None:
+        query += f" LIMIT {int(cap)}"
+
+    cursors = []
+    async with conn.pipeline():
+        for address in addresses:
+            cursor = conn.cursor()
+            await cursor.execute(query, {"address": address})
+            cursors.append((address, cursor))
+
+        # The first fetch syncs the pipeline, the rest are already buffered
+        return {address: await cursor.fetchall() for address, cursor in cursors}
+
+
+# Joins the query fingerprints against the index and builds the (songId, time delta)
+# histogram server side, couple is anchorTime << 32 | songId
+OFFSET_HISTOGRAM_QUERY = """
+WITH query AS (
+    SELECT * FROM unnest(%(addresses)s::bigint[], %(anchorTimes)s::bigint[])
+        AS q(address, anchorTime)
+),
+matched AS (
+    SELECT query.anchorTime, ac.couple
+    FROM query JOIN address_couple ac ON ac.address = query.address
+    UNION ALL
+    SELECT query.anchorTime, c.couple
+    FROM query JOIN posting p ON p.address = query.address,
+        unnest(p.couples) AS c(couple)
+),
+hits AS (
+    SELECT couple & 4294967295 AS songId,
+        floor((((couple >> 32) & 4294967295) - anchorTime)::float8
+            / %(deltaBin)s)::bigint AS delta
+    FROM matched
+),
+histogram AS (
+    SELECT songId, delta, count(*) AS coherency FROM hits GROUP BY songId, delta
+),
+best AS (
+    SELECT DISTINCT ON (songId) songId, delta, coherency,
+        sum(coherency) OVER (PARTITION BY songId) AS hits
+    FROM histogram
+    ORDER BY songId, coherency DESC
+)
+SELECT songId, delta * %(deltaBin)s, coherency, hits FROM best
+WHERE hits >= %(minHits)s
+ORDER BY coherency DESC
+LIMIT %(topK)s
+"""
+
+
+def scoreOffsetHistogram(conn, addresses, anchorTimes, topK, minHits=1, deltaBin=1):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            OFFSET_HISTOGRAM_QUERY,
+            {
+                "addresses": addresses,
+                "anchorTimes": anchorTimes,
+                "deltaBin": deltaBin,
+                "minHits": minHits,
+                "topK": topK,
+            },
+        )
+        return cursor.fetchall()
+
+
+def readAddressCouplesFromAddresses(conn, addresses):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT * FROM address_couple WHERE address = ANY(%s)", [list(addresses)]
+        )
+        return cursor.fetchall()
+
+
+def readPackedPostings(conn, addresses):
+    # array_send keeps the couples binary, codec.unpackCouples decodes them
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT address, array_send(couples) FROM posting WHERE address = ANY(%s)",
+            [list(addresses)],
+        )
+        return cursor.fetchall()
+
+
+def readAddressCouplesCapped(conn, addresses, cap):
+    # At most cap couples per address, for posting lists too long to fetch whole
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT a.address, ac.couple FROM unnest(%s::bigint[]) AS a(address)
+            CROSS JOIN LATERAL (
+                SELECT couple FROM address_couple WHERE address = a.address
+                UNION ALL
+                SELECT unnest(couples) FROM posting WHERE address = a.address
+                LIMIT %s
+            ) ac
+            """,
+            [list(addresses), cap],
+        )
+        return cursor.fetchall()
+
+
+# Document frequency of an address is the number of distinct songs in its posting list
+POSTING_LIST_STATS_QUERY = f"""
+WITH lists AS (
+    SELECT address, count(*) AS postings,
+        count(DISTINCT couple & 4294967295) AS df
+    FROM {ALL_COUPLES} ac GROUP BY address
+),
+packed AS (
+    SELECT count(*) AS packedAddresses,
+        coalesce(sum(pg_column_size(couples)), 0) AS packedBytes
+    FROM posting
+)
+SELECT count(*), coalesce(sum(postings), 0), coalesce(max(df), 0),
+    percentile_cont(ARRAY[0.5, 0.9, 0.99, 0.999]) WITHIN GROUP (ORDER BY df),
+    count(*) FILTER (WHERE df > %(maxDf)s),
+    (SELECT packedAddresses FROM packed), (SELECT packedBytes FROM packed),
+    pg_total_relation_size('address_couple'), pg_total_relation_size('posting')
+FROM lists
+"""
+
+
+def readPostingListStats(conn, maxDf):
+    with conn.cursor() as cursor:
+        cursor.execute(POSTING_LIST_STATS_QUERY, {"maxDf": maxDf})
+        return cursor.fetchone()
+
+
+def storeStopAddresses(conn, maxDf, action="skip", cap=None):
+    # The stop list is stored with what it was built for, so loads and searches apply
+    # the same action and weigh by the same maxDf
+    with conn.cursor() as cursor:
+        createMeta(cursor)
+        cursor.execute(
+            "INSERT INTO meta (key, value) VALUES ('stop_list', %s) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            [json.dumps({"action": action, "maxDf": maxDf, "cap": cap})],
+        )
+        cursor.execute("DELETE FROM stop_address")
+        cursor.execute(
+            f"""
+            INSERT INTO stop_address (address, df, postings)
+            SELECT address, count(DISTINCT couple & 4294967295), count(*)
+            FROM {ALL_COUPLES} ac GROUP BY address
+            HAVING count(DISTINCT couple & 4294967295) > %s
+            """,
+            [maxDf],
+        )
+        stored = cursor.rowcount
+        bumpCatalogVersion(cursor)
+    conn.commit()
+    return stored
+
+
+def readStopAddresses(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT address, df FROM stop_address")
+        return cursor.fetchall()
+
+
+def readStopList(conn):
+    # The action, maxDf and cap the stop list was built with, None when unknown
+    found = readMeta(conn, "stop_list")
+    return None if found is None else json.loads(found)
+
+
+def reserveStopCouples(conn, counts, cap=None):
+    # counts maps the stop addresses of a new tone to its couples under each. Returns
+    # how many of them to store, keeping every stop address to cap couples in total,
+    # and counts them into stop_address so df and postings stay current
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT address, postings FROM stop_address WHERE address = ANY(%s) "
+            "ORDER BY address FOR UPDATE",
+            [list(counts)],
+        )
+        allowed = {}
+        for address, postings in cursor.fetchall():
+            room = counts[address] if cap is None else max(0, cap - postings)
+            allowed[address] = min(room, counts[address])
+        cursor.executemany(
+            "UPDATE stop_address SET df = df + 1, postings = postings + %s "
+            "WHERE address = %s",
+            [(n, address) for address, n in allowed.items() if n > 0],
+        )
+        bumpCatalogVersion(cursor)
+    conn.commit()
+    return allowed
+
+
+# Binary COPY framing, rows in between are a field count then length and value pairs
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+COPY_TRAILER = b"\xff\xff"
+COUPLE_ROW = np.dtype(
+    [
+        ("fields", ">i2"),
+        ("addressLength", ">i4"),
+        ("address", ">i8"),
+        ("coupleLength", ">i4"),
+        ("couple", ">i8"),
+    ]
+)
+POSTING_ROW = struct.Struct(">hiqi")
+COPY_BLOCK_ROWS = 1 << 16
+
+
+def readSortedTones(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT toneId, name FROM tone ORDER BY toneId")
+        return cursor.fetchall()
+
+
+def readMetaRows(conn):
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("SELECT key, value FROM meta")
+        except sql.errors.UndefinedTable:
+            conn.rollback()
+            return dict(LEGACY_META)
+        return dict(cursor.fetchall())
+
+
+def readSortedCouples(conn, blockRows=COPY_BLOCK_ROWS):
+    # Every couple by address then couple, as (addresses, couples) arrays of about
+    # blockRows, so a whole catalog streams through bounded memory
+    query = f"""
+        COPY (SELECT address, couple FROM {ALL_COUPLES} ac ORDER BY address, couple)
+        TO STDOUT (FORMAT BINARY)
+        """
+    with conn.cursor() as cursor:
+        with cursor.copy(query) as copy:
+            pending = b""
+            blocks = []
+            for block in copy:
+                # Postgres sends a row per block, they are parsed in bulk
+                blocks.append(bytes(block))
+                if len(blocks) < blockRows:
+                    continue
+                addresses, couples, pending = parseCoupleRows(pending, blocks)
+                blocks = []
+                if len(addresses):
+                    yield addresses, couples
+            addresses, couples, pending = parseCoupleRows(pending, blocks)
+            if len(addresses):
+                yield addresses, couples
+            if pending != COPY_TRAILER:
+                raise ValueError("COPY stream ended inside a row")
+
+
+def parseCoupleRows(pending, blocks):
+    data = pending + b"".join(blocks)
+    if data.startswith(COPY_HEADER):
+        data = data[len(COPY_HEADER) :]
+    rows = len(data) // COUPLE_ROW.itemsize
+    parsed = np.frombuffer(data, dtype=COUPLE_ROW, count=rows)
+    return (
+        parsed["address"].astype(np.int64),
+        parsed["couple"].astype(np.int64),
+        data[rows * COUPLE_ROW.itemsize :],
+    )
+
+
+def storePostings(conn, postings):
+    # (address, couples) pairs straight into packed posting rows, no compaction needed
+    stored = 0
+    with conn.cursor() as cursor:
+        with cursor.copy(
+            "COPY posting (address, couples) FROM STDIN (FORMAT BINARY)"
+        ) as copy:
+            copy.write(COPY_HEADER)
+            for address, couples in postings:
+                packed = packCouples(couples)
+                copy.write(POSTING_ROW.pack(2, 8, int(address), len(packed)) + packed)
+                stored += 1
+            copy.write(COPY_TRAILER)
+        bumpCatalogVersion(cursor)
+    conn.commit()
+    return stored
+
+
+def storeTones(conn, tones):
+    with conn.cursor() as cursor:
+        with cursor.copy("COPY tone (toneId, name) FROM STDIN") as copy:
+            for toneId, name in tones:
+                copy.write_row((int(toneId), name))
+    conn.commit()
+
+
+def storeMetaRows(conn, meta):
+    # The catalog version is the database's own, not the one the rows were read with
+    with conn.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO meta (key, value) VALUES (%s, %s) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            [(key, value) for key, value in meta.items() if key != "catalog_version"],
+        )
+        bumpCatalogVersion(cursor)
+    conn.commit()
@@ -1,9 +1,45 @@
 from pathlib import Path
+import asyncio
+import json
 import signal
 from typing import Iterable
 from argparse import ArgumentParser
-from db_utils import createDatabase
-from search_load import searchFile, loadFile, loadFolders
+from db_utils import compactPostings, createDatabase, readDistinctAddresses
+from stopwords import (
+    STOP_ACTIONS,
+    STOP_CAP,
+    STOP_MAX_DF,
+    buildStopAddresses,
+    loadStopPolicy,
+    postingListStats,
+)
+from caches import getPostingCache, getResultCache
+from constellation import (
+    FAN_OUT,
+    PEAKS_PER_SECOND,
+    PICKERS,
+    FingerprintConfig,
+    isConstellation,
+)
+from codec import CODECS
+from artifacts import ARTIFACT_DIR
+import profiling
+from bloom import BLOOM_PATH, FALSE_POSITIVE_RATE, buildBloomFilter, getBloomFilter
+from snapshot import Snapshot, exportSnapshot, importSnapshot
+from search_load import (
+    TOP_K,
+    MIN_HITS,
+    MAX_QUERY_SECONDS,
+    searchFile,
+    searchFileSQL,
+    searchFileProgressive,
+    loadFile,
+    loadFolders,
+    loadArtifacts,
+    listAudioFiles,
+)
+from scan import scanFile
+from stream import recognizeFileStreaming, recognizeMicrophone
 
 
 if __name__ == "__main__":
@@ -23,7 +59,7 @@ if __name__ == "__main__":
         metavar="mode",
         required=True,
         type=str,
-        help="Mode of operation: load, load_folder, search",
+        help="Mode of operation: load, load_folder, search, search_async, search_sql, search_progressive, scan, stream, listen, build_bloom, build_stoplist, compact, rebuild, stats, export, import",
     )
 
     parser.add_argument(
@@ -48,25 +84,237 @@ if __name__ == "__main__":
         help="Overwrite existing db",
     )
 
+    parser.add_argument(
+        "--top-k",
+        default=TOP_K,
+        type=int,
+        help="Number of candidate tones kept for coherency scoring",
+    )
+
+    parser.add_argument(
+        "--min-hits",
+        default=MIN_HITS,
+        type=int,
+        help="Minimum fingerprint hits for a tone to be scored",
+    )
+
+    parser.add_argument(
+        "--start",
+        default=None,
+        type=float,
+        help="Seconds into the query file to start fingerprinting from",
+    )
+
+    parser.add_argument(
+        "--duration",
+        default=MAX_QUERY_SECONDS,
+        type=float,
+        help=f"Seconds of the query file to fingerprint, 0 for all (default {MAX_QUERY_SECONDS})",
+    )
+
+    parser.add_argument(
+        "--bloom",
+        default=BLOOM_PATH,
+        type=str,
+        help="Bloom filter over stored addresses, used to skip lookups that cannot match",
+    )
+
+    parser.add_argument(
+        "--bloom-fp-rate",
+        default=FALSE_POSITIVE_RATE,
+        type=float,
+        help="False positive rate the bloom filter is sized for in build_bloom",
+    )
+
+    parser.add_argument(
+        "--stop-action",
+        default=None,
+        choices=["none", *STOP_ACTIONS],
+        help="What to do with addresses in the stop list: skip, cap or downweight them, on load and search. Defaults to the action the stop list was built for",
+    )
+
+    parser.add_argument(
+        "--stop-max-df",
+        default=STOP_MAX_DF,
+        type=int,
+        help="Addresses found in more songs than this are stop addresses, for build_stoplist and stats",
+    )
+
+    parser.add_argument(
+        "--stop-cap",
+        default=None,
+        type=int,
+        help=f"Couples kept per stop address with --stop-action cap, defaults to the cap the stop list was built with or {STOP_CAP}",
+    )
+
+    parser.add_argument(
+        "--picker",
+        default="bands",
+        choices=PICKERS,
+        help="Peak picker, load and search must use the same one",
+    )
+
+    parser.add_argument(
+        "--peaks-per-second",
+        default=PEAKS_PER_SECOND,
+        type=int,
+        help="Peak budget of the constellation picker",
+    )
+
+    parser.add_argument(
+        "--fan-out",
+        default=FAN_OUT,
+        type=int,
+        help="Target peaks paired with every anchor by the constellation picker",
+    )
+
+    parser.add_argument(
+        "--codec",
+        default=1,
+        type=int,
+        choices=sorted(CODECS),
+        help="Address codec version, must match the one the database was loaded with",
+    )
+
+    parser.add_argument(
+        "--artifacts",
+        default=None,
+        nargs="?",
+        const=ARTIFACT_DIR,
+        help=f"Cache fingerprints in this folder (default {ARTIFACT_DIR}) so a reload or rebuild skips decoding",
+    )
+
+    parser.add_argument(
+        "--shards",
+        default=None,
+        nargs="+",
+        metavar="DSN",
+        help="Split fingerprints by address hash over these databases, or schemas with options='-c search_path=...', the main database keeps the tones",
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        default=None,
+        help="Serve search and search_progressive from an exported snapshot file instead of the database fingerprints",
+    )
+
+    parser.add_argument(
+        "--profile",
+        default=None,
+        nargs="?",
+        const="-",
+        help="Write per-stage timings and DB counters as JSON to a file, or stdout",
+    )
+
     args = parser.parse_args()
     mode = args.mode
     filename = args.filename
     v = args.verbose
     overwrite = args.overwrite
+    topK = args.top_k
+    minHits = args.min_hits
+    window = {"start": args.start, "duration": args.duration}
+    bloomPath = args.bloom
+    stopMaxDf = args.stop_max_df
+    if args.profile is not None:
+        profiling.enable()
+    config = FingerprintConfig(
+        picker=args.picker,
+        peaksPerSecond=args.peaks_per_second,
+        fanOut=args.fan_out,
+        codec=args.codec,
+    )
 
     db = "dbname=tones user=mads"
     # db = "dbname=songs user=mads"
+    shards = args.shards
+    if shards and mode in [
+        "search_sql",
+        "search_async",
+        "build_stoplist",
+        "stats",
+        "export",
+        "import",
+    ]:
+        print(f"{mode} does not support a sharded store")
+        exit(1)
+    if args.snapshot and mode not in ["search", "search_progressive"]:
+        print(f"{mode} cannot be served from a snapshot")
+        exit(1)
+    if args.snapshot and args.stop_action not in [None, "none"]:
+        print("A snapshot is served without a stop list")
+        exit(1)
+
+    stats = {}
+    cache = getPostingCache(db)
+    stopPolicy = None
+    # load_folder --overwrite, rebuild and import drop the catalog and its stop list
+    # with it, so they load without one
+    recreate = mode in ["rebuild", "import"] or mode == "load_folder" and overwrite
+    # A snapshot replica may have no database, and the local bloom filter was built
+    # over another catalog than the snapshot's
+    if args.stop_action != "none" and not recreate and not args.snapshot:
+        stopPolicy = loadStopPolicy(db, args.stop_action, args.stop_cap)
+    searchArgs = {
+        "topK": topK,
+        "minHits": minHits,
+        "bloom": None if args.snapshot else getBloomFilter(bloomPath),
+        "stopPolicy": stopPolicy,
+        "config": config,
+        "stats": stats,
+        **window,
+    }
+    if shards:
+        searchArgs["shards"] = shards
+    if args.snapshot:
+        searchArgs["snapshot"] = args.snapshot
 
     res = None
 
     match mode:
         case "load":
-            loadFile(db, filename, verbose=v)
+            loadFile(
+                db,
+                filename,
+                verbose=v,
+                bloomPath=bloomPath,
+                stopPolicy=stopPolicy,
+                config=config,
+                artifactDir=args.artifacts,
+                shards=shards,
+            )
         case "load_folder":
             if overwrite:
                 print("Overwriting database")
-                createDatabase(db, "./src/db/schema.sql")
-            loadFolders(db, Path(filename), verbose=v, maxWorkers=5)
+                for dsn in [db] + (shards or []):
+                    createDatabase(dsn, "./src/db/schema.sql")
+            loadFolders(
+                db,
+                Path(filename),
+                verbose=v,
+                maxWorkers=5,
+                bloomPath=bloomPath,
+                stopPolicy=stopPolicy,
+                config=config,
+                artifactDir=args.artifacts,
+                shards=shards,
+            )
+            compacted = sum(compactPostings(dsn) for dsn in shards or [db])
+            print(f"Compacted {compacted} posting lists")
+        case "rebuild":
+            # Recreates the index from cached fingerprints, filename is not read
+            for dsn in [db] + (shards or []):
+                createDatabase(dsn, "./src/db/schema.sql")
+            loaded = loadArtifacts(
+                db,
+                args.artifacts or ARTIFACT_DIR,
+                bloomPath=bloomPath,
+                stopPolicy=stopPolicy,
+                config=config,
+                shards=shards,
+            )
+            compacted = sum(compactPostings(dsn) for dsn in shards or [db])
+            print(f"Loaded {loaded} tones, compacted {compacted} posting lists")
         case "search":
             res = searchFile(
                 db,
@@ -75,11 +323,132 @@ if __name__ == "__main__":
                 coeff=10,
                 timeFreqTol=(0.5, 0.5),
                 coherencyTol=2.5,
+                cache=cache,
+                **searchArgs,
+            )
+        case "search_sql":
+            res = searchFileSQL(db, filename, verbose=v, **searchArgs)
+        case "search_progressive":
+            res = searchFileProgressive(
+                db, filename, verbose=v, cache=cache, **searchArgs
+            )
+        case "search_async":
+            # psycopg_pool is only needed here
+            from search_async import searchFilesAsync
+
+            path = Path(filename)
+            filenames = [path] if path.is_file() else sorted(listAudioFiles(path))
+            results = asyncio.run(
+                searchFilesAsync(
+                    db,
+                    [str(file) for file in filenames],
+                    verbose=v,
+                    coeff=10,
+                    timeFreqTol=(0.5, 0.5),
+                    coherencyTol=2.5,
+                    cache=cache,
+                    resultCache=getResultCache(db),
+                    **searchArgs,
+                )
             )
+            for file, found in zip(filenames, results):
+                print(f"{file}: {found}")
+        case "scan":
+            segments = scanFile(
+                db,
+                filename,
+                bloom=searchArgs["bloom"],
+                cache=cache,
+                stopPolicy=stopPolicy,
+                config=config,
+                verbose=v,
+                shards=shards,
+                stats=stats,
+            )
+            for tone, startMs, endMs, score in segments:
+                print(f"{startMs / 1000:.1f}s - {endMs / 1000:.1f}s: {tone} ({score})")
+        case "stream" | "listen":
+            if isConstellation(config):
+                print("Streaming recognition only supports the bands picker")
+                exit(1)
+            if mode == "stream":
+                match = recognizeFileStreaming(
+                    db,
+                    filename,
+                    bloom=searchArgs["bloom"],
+                    cache=cache,
+                    stopPolicy=stopPolicy,
+                    config=config,
+                    shards=shards,
+                )
+            else:
+                match = recognizeMicrophone(
+                    db,
+                    bloom=searchArgs["bloom"],
+                    cache=cache,
+                    stopPolicy=stopPolicy,
+                    config=config,
+                    shards=shards,
+                )
+            if match is not None:
+                print(
+                    f"Matched after {match.streamMs} ms of audio, {match.latencyMs:.1f} ms after the last chunk"
+                )
+                res = match.tone
+        case "build_bloom":
+            addresses = []
+            for dsn in shards or [db]:
+                addresses += readDistinctAddresses(dsn)
+            bloom = buildBloomFilter(addresses, bloomPath, args.bloom_fp_rate)
+            print(f"Wrote {bloom.count} addresses to {bloomPath}")
+        case "build_stoplist":
+            count = buildStopAddresses(
+                db,
+                stopMaxDf,
+                args.stop_action if args.stop_action in STOP_ACTIONS else "skip",
+                args.stop_cap or STOP_CAP,
+            )
+            print(f"Stored {count} stop addresses found in more than {stopMaxDf} songs")
+        case "export":
+            addresses, couples, tones = exportSnapshot(db, filename)
+            print(
+                f"Exported {couples} couples under {addresses} addresses and {tones} tones to {filename}"
+            )
+        case "import":
+            # Replaces the database with the snapshot, filename is the snapshot
+            snapshot = Snapshot(filename)
+            createDatabase(db, "./src/db/schema.sql")
+            print(f"Imported {importSnapshot(db, snapshot)} posting lists")
+            if Path(bloomPath).exists():
+                bloom = buildBloomFilter(
+                    snapshot.addresses, bloomPath, args.bloom_fp_rate
+                )
+                print(f"Wrote {bloom.count} addresses to {bloomPath}")
+        case "compact":
+            compacted = sum(compactPostings(dsn) for dsn in shards or [db])
+            print(f"Compacted {compacted} posting lists")
+        case "stats":
+            for key, value in postingListStats(db, stopMaxDf).items():
+                print(f"{key}: {value}")
         case _:
             print("Invalid mode")
             exit(1)
 
+    if stats:
+        print(", ".join(f"{key}: {value}" for key, value in stats.items()))
+    if cache.hits or cache.misses:
+        cacheStats = cache.stats()
+        print(
+            "Posting cache: "
+            + ", ".join(f"{key}: {value}" for key, value in cacheStats.items())
+        )
+
+    if args.profile == "-":
+        print(json.dumps(profiling.report(), indent=2))
+    elif args.profile is not None:
+        with open(args.profile, "w") as f:
+            json.dump(profiling.report(), f, indent=2)
+
     if res is not None:
         if isinstance(res, Iterable) and not isinstance(res, str):
             print("Found tones:")
@@ -0,0 +1,80 @@
+from contextlib import contextmanager, nullcontext
+import time
+
+# Set by enable, every hook is a None check while profiling is off
+_profile = None
+_NOOP = nullcontext()
+
+
+class Profile:
+    """
+    Wall time, CPU time and call count per stage, plus counters such as DB
+    round trips, rows fetched and bytes decoded.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            totals["calls"] += 1
+            totals["wall"] += time.perf_counter() - wall
+            totals["cpu"] += time.process_time() - cpu
+
+    def count(self, amounts):
+        for key, n in amounts.items():
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def merge(self, report):
+        # Adds a report from another process, such as a loadFolders worker
+        for name, totals in report["stages"].items():
+            mine = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            for key, value in totals.items():
+                mine[key] += value
+        self.count(report["counters"])
+
+    def report(self):
+        return {"stages": self.stages, "counters": self.counters}
+
+
+def enable():
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+def enabled():
+    return _profile is not None
+
+
+def stage(name):
+    if _profile is None:
+        return _NOOP
+    return _profile.stage(name)
+
+
+def count(**amounts):
+    if _profile is not None:
+        _profile.count(amounts)
+
+
+def merge(other):
+    if _profile is not None:
+        _profile.merge(other)
+
+
+def report():
+    return _profile.report() if _profile is not None else None
+
+
+def profiled(func, *args):
+    # Runs func in a worker process with its own profile, returns its result and report
+    profile = enable()
+    return func(*args), profile.report()
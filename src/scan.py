@@ -0,0 +1,269 @@
+from collections import deque
+import math
+import time
+import numpy as np
+import psycopg as sql
+
+from audio_proc import WAVInfo
+from audio_utils import decodeStream, processAudiofile
+from caches import getToneCache
+from constellation import DEFAULT_CONFIG, configCodec, isConstellation
+from db_utils import checkConfig
+from scoring import DELTA_BIN_MS
+from search_load import EMPTY_POSTING, lookupAddresses, stopWeight
+from shards import checkShards, getShardPool
+from stream import StreamFingerprinter
+
+# The recording is decoded once and fingerprinted as a stream in blocks, a window
+# is the last WINDOW_BLOCKS blocks so consecutive windows share all but one block
+# of fingerprints
+BLOCK_SECONDS = 5
+WINDOW_BLOCKS = 3
+MIN_SCORE = 20
+
+
+class WindowFingerprinter:
+    """
+    Stream fingerprints for the constellation picker, whose peaks depend on up to
+    thresholdMs of context on either side. Every block is fingerprinted together
+    with the tail before it, and only pairs whose anchor and target zone peaks
+    have all their context are kept, the rest come out with the next block or the
+    flush. Windows start on a whole number of seconds that is also a whole number
+    of STFT hops, so frame times and the peaksPerSecond budget line up with a
+    whole-file fingerprint.
+    """
+
+    def __init__(self, sampleFreq, channels, config):
+        self.config = config
+        self.sampleFreq = sampleFreq
+        self.channels = channels
+        self.bytesSec = sampleFreq * channels * 2
+
+        # Same window arithmetic as processAudiofile/generateSpectograph, in
+        # decimated samples, a period is the shortest whole-second whole-hop span
+        factor = max(1, config.downsampleFactor)
+        rate = sampleFreq // factor
+        windowSize = int(int(rate / config.targetRes) / rate * rate)
+        period = math.lcm(windowSize - int(windowSize * 0.5), rate)
+        self.periodMs = period // rate * 1000
+        self.periodBytes = period * factor * channels * 2
+        self.timelineBytesSec = rate * factor * channels * 2
+
+        self.marginMs = config.thresholdMs // 2 + config.neighborhoodMs
+        self.guardMs = config.zoneEndMs + 1000 + self.marginMs
+        self.tail = b""
+        self.tailMs = 0
+        self.emittedMs = 0
+
+    def _pairs(self, data):
+        info = WAVInfo(
+            sampleFreq=self.sampleFreq,
+            bytesSec=self.bytesSec,
+            blockAlign=self.channels * 2,
+            bitsPerSample=16,
+            data=data,
+        )
+        try:
+            addressCouple = processAudiofile(info, None, toneId=0, config=self.config)
+        except (IndexError, ValueError):
+            # Too short to hold a single frame
+            return []
+        return [
+            (address, (int(anchorTime) + self.tailMs, songId))
+            for address, (anchorTime, songId) in addressCouple
+        ]
+
+    def fingerprint(self, chunk):
+        data = self.tail + chunk
+        settledMs = (
+            self.tailMs + len(data) * 1000 // self.timelineBytesSec - self.guardMs
+        )
+        addressCouple = [
+            pair
+            for pair in self._pairs(data)
+            if self.emittedMs <= pair[1][0] < settledMs
+        ]
+        self.emittedMs = max(self.emittedMs, settledMs)
+
+        periods = (self.emittedMs - self.marginMs - self.tailMs) // self.periodMs
+        periods = max(0, periods)
+        self.tail = data[periods * self.periodBytes :]
+        self.tailMs += periods * self.periodMs
+        return addressCouple
+
+    def flush(self):
+        addressCouple = [
+            pair for pair in self._pairs(self.tail) if pair[1][0] >= self.emittedMs
+        ]
+        self.tail = b""
+        return addressCouple
+
+
+def streamFingerprinter(sampleFreq, channels, config=None):
+    config = config or DEFAULT_CONFIG
+    if isConstellation(config):
+        return WindowFingerprinter(sampleFreq, channels, config)
+    return StreamFingerprinter(sampleFreq, config)
+
+
+def mergeBins(ids, deltas, counts, first, last):
+    # Sums the counts and joins the spans of equal (songId, delta) bins, merged bins
+    # stay in order of first appearance
+    if len(ids) == 0:
+        return ids, deltas, counts, first, last
+    order = np.lexsort((deltas, ids))
+    ids, deltas = ids[order], deltas[order]
+    starts = np.flatnonzero(
+        (np.diff(ids, prepend=ids[0] - 1) != 0)
+        | (np.diff(deltas, prepend=deltas[0] - 1) != 0)
+    )
+    appearance = np.argsort(order[starts])
+    return (
+        ids[starts][appearance],
+        deltas[starts][appearance],
+        np.add.reduceat(counts[order], starts)[appearance],
+        np.minimum.reduceat(first[order], starts)[appearance],
+        np.maximum.reduceat(last[order], starts)[appearance],
+    )
+
+
+def scoreBlock(
+    conn,
+    addressCouple,
+    deltaBin,
+    bloom=None,
+    cache=None,
+    stopPolicy=None,
+    config=None,
+    shards=None,
+):
+    # Anchor times are already in recording time
+    codec = configCodec(config)
+    encoded = [codec.encodeAddress(address) for address, _ in addressCouple]
+    reads = lookupAddresses(
+        conn, encoded, bloom=bloom, cache=cache, stopPolicy=stopPolicy, shards=shards
+    )
+
+    # Every hit as (songId, delta bin) with its weight and anchor time, then merged
+    # into bins of [count, first hit, last hit] in recording time
+    lengths = [len(reads[address]) for address in encoded]
+    couples = np.concatenate([EMPTY_POSTING] + [reads[address] for address in encoded])
+    anchorTimes = np.repeat(
+        np.array([couple[0] for _, couple in addressCouple], dtype=np.int64), lengths
+    )
+    weights = [stopWeight(stopPolicy, address) for address in encoded]
+    weights = np.repeat(np.array(weights, dtype=np.result_type(*weights, 1)), lengths)
+    ids = couples & 0xFFFFFFFF
+    deltas = (((couples >> 32) & 0xFFFFFFFF) - anchorTimes) // deltaBin
+    return mergeBins(ids, deltas, weights, anchorTimes, anchorTimes)
+
+
+def windowMatches(blocks, minScore):
+    ids, deltas, counts, first, last = mergeBins(
+        *(np.concatenate(part) for part in zip(*blocks))
+    )
+
+    # Best delta per song as (delta, count, first, last), the earliest bin wins ties,
+    # songs in order of their first bin above minScore
+    above = np.flatnonzero(counts >= minScore)
+    byCount = above[np.lexsort((above, -counts[above], ids[above]))]
+    bySong = above[np.argsort(ids[above], kind="stable")]
+    starts = np.flatnonzero(np.diff(ids[bySong], prepend=-1) != 0)
+    best = byCount[starts][np.argsort(bySong[starts])]
+    return dict(
+        zip(
+            ids[best].tolist(),
+            zip(
+                deltas[best].tolist(),
+                counts[best].tolist(),
+                first[best].tolist(),
+                last[best].tolist(),
+            ),
+        )
+    )
+
+
+def scanFile(
+    db,
+    filename,
+    blockSeconds=BLOCK_SECONDS,
+    windowBlocks=WINDOW_BLOCKS,
+    minScore=MIN_SCORE,
+    deltaBin=DELTA_BIN_MS,
+    bloom=None,
+    cache=None,
+    stopPolicy=None,
+    config=None,
+    verbose=False,
+    shards=None,
+    stats=None,
+):
+    toneNames = getToneCache(db)
+
+    blocks = deque(maxlen=windowBlocks)
+    active = {}
+    segments = []
+
+    def close(songId):
+        _, start, end, score = active.pop(songId)
+        segments.append((toneNames.name(songId), start, end, score))
+
+    def step(addressCouple, label):
+        blocks.append(
+            scoreBlock(
+                conn,
+                addressCouple,
+                deltaBin,
+                bloom,
+                cache,
+                stopPolicy,
+                config,
+                pool,
+            )
+        )
+        matches = windowMatches(blocks, minScore)
+
+        if verbose:
+            print(f"{label}: {len(matches)} tones above {minScore}")
+
+        for songId in list(active):
+            if songId not in matches or abs(matches[songId][0] - active[songId][0]) > 1:
+                close(songId)
+
+        for songId, (delta, count, first, last) in matches.items():
+            if songId in active:
+                _, start, end, score = active[songId]
+                active[songId] = (
+                    delta,
+                    min(start, first),
+                    max(end, last),
+                    max(score, count),
+                )
+            else:
+                active[songId] = (delta, first, last, count)
+
+    pool = getShardPool(shards)
+    started = time.perf_counter()
+    audioBytes = 0
+    with sql.connect(db) as conn:
+        checkConfig(conn, config)
+        checkShards(conn, shards)
+        sampleFreq, channels, chunks = decodeStream(filename, blockSeconds)
+        fingerprinter = streamFingerprinter(sampleFreq, channels, config)
+        for i, chunk in enumerate(chunks):
+            audioBytes += len(chunk)
+            step(fingerprinter.fingerprint(chunk), f"{i * blockSeconds}s")
+        step(fingerprinter.flush(), "end")
+
+    for songId in list(active):
+        close(songId)
+
+    if stats is not None:
+        # Real-time factor: seconds of recording scanned per second of wall time
+        audioSeconds = audioBytes / (sampleFreq * channels * 2)
+        scanSeconds = time.perf_counter() - started
+        stats["audioSeconds"] = round(audioSeconds, 1)
+        stats["scanSeconds"] = round(scanSeconds, 2)
+        stats["realtimeFactor"] = round(audioSeconds / scanSeconds, 1)
+
+    return sorted(segments, key=lambda segment: segment[1])
@@ -0,0 +1,74 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from operator import itemgetter
+import numpy as np
+
+DELTA_BIN_MS = 10
+
+
+@dataclass
+class OffsetHistogram:
+    """
+    Histogram of (db anchorTime - query anchorTime) bins, updated as hits arrive.
+
+    counts is keyed by songId << 32 | delta bin so whole posting lists are counted
+    at once, best holds the tallest bin of every song so the leaders can be read
+    without rescanning the histogram.
+    """
+
+    deltaBin: int = DELTA_BIN_MS
+    counts: Counter = field(default_factory=Counter)
+    best: Counter = field(default_factory=Counter)
+    hits: Counter = field(default_factory=Counter)
+
+    def add(self, anchorTime, couples, weight=1):
+        couples = np.asarray(couples, dtype=np.int64)
+        if len(couples) == 0:
+            return
+        ids = couples & 0xFFFFFFFF
+        deltas = (((couples >> 32) & 0xFFFFFFFF) - int(anchorTime)) // self.deltaBin
+        keys = ((ids << 32) | (deltas & 0xFFFFFFFF)).tolist()
+
+        if weight == 1:
+            self.counts.update(keys)
+        else:
+            bins, n = np.unique(keys, return_counts=True)
+            for key, n in zip(bins.tolist(), n.tolist()):
+                self.counts[key] += weight * n
+        heights = np.array(itemgetter(*keys)(self.counts), ndmin=1)
+
+        self.hits.update(ids.tolist())
+
+        # Only songs whose tallest bin grew are updated, in order of first appearance
+        # as the per-couple loop added them to best
+        songs, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        tallest = np.zeros(len(songs), dtype=heights.dtype)
+        np.maximum.at(tallest, inverse, heights)
+        order = np.argsort(first)
+        songs, tallest = songs[order], tallest[order]
+        current = np.array(itemgetter(*songs.tolist())(self.best), ndmin=1)
+        grew = tallest > current
+        for songId, height in zip(songs[grew].tolist(), tallest[grew].tolist()):
+            self.best[songId] = height
+
+    def leaders(self, n=2, minHits=1):
+        return [
+            (songId, coherency)
+            for songId, coherency in self.best.most_common()
+            if self.hits[songId] >= minHits
+        ][:n]
+
+
+def isConfident(leaders, numTargetZones, coeff, margin, minHits=1):
+    """
+    The leader passes the usual coeff * numTargetZones threshold and beats the
+    runner-up by margin.
+    """
+    if not leaders:
+        return False
+
+    _, best = leaders[0]
+    runnerUp = leaders[1][1] if len(leaders) > 1 else 0
+    return (
+        best >= minHits and best >= numTargetZones * coeff and best >= runnerUp * margin
+    )
@@ -0,0 +1,226 @@
+import asyncio
+from concurrent.futures.process import ProcessPoolExecutor
+import numpy as np
+import psycopg as sql
+from psycopg_pool import AsyncConnectionPool
+
+from db_utils import checkConfig, readAddressCouplesPipelined, readCatalogVersionAsync
+from caches import MISS, getToneCache
+from stopwords import splitStopAddresses
+from constellation import configCodec
+from shards import checkShards
+import profiling
+from profiling import stage
+from search_load import (
+    TOP_K,
+    MIN_HITS,
+    COHERENCY_COEFF,
+    MAX_QUERY_SECONDS,
+    EMPTY_POSTING,
+    countStat,
+    skipMisses,
+    cachedAddresses,
+    stopWeight,
+    fingerprintFile,
+    decodeQuery,
+    fingerprintQuery,
+    addMatches,
+    rankMatches,
+    searchKey,
+)
+
+POOL_SIZE = 4
+MAX_DECODERS = 2
+
+
+async def checkVersionAsync(pool, cache):
+    if cache is not None and cache.due():
+        async with pool.connection() as conn:
+            cache.checkVersion(await readCatalogVersionAsync(conn))
+
+
+async def lookupAddressesAsync(
+    pool,
+    addresses,
+    poolSize=POOL_SIZE,
+    stats=None,
+    bloom=None,
+    cache=None,
+    stopPolicy=None,
+):
+    addresses = list(set(addresses))
+    reads = {address: EMPTY_POSTING for address in addresses}
+
+    await checkVersionAsync(pool, cache)
+
+    addresses = skipMisses(addresses, bloom, stats=stats)
+    addresses, capped = splitStopAddresses(addresses, stopPolicy, stats=stats)
+    # The cache only holds whole posting lists, capped reads always go to the store
+    addresses = cachedAddresses(addresses, reads, cache, stats=stats)
+
+    # Spread the addresses over the pool, each slice is pipelined on its own connection
+    async def lookup(chunk, cap=None):
+        async with pool.connection() as conn:
+            return await readAddressCouplesPipelined(conn, chunk, cap=cap)
+
+    chunks = [(addresses[i::poolSize], None) for i in range(poolSize)]
+    if capped:
+        chunks += [(capped[i::poolSize], stopPolicy.cap) for i in range(poolSize)]
+    chunks = [(chunk, cap) for chunk, cap in chunks if chunk]
+    # Lookups of concurrent searches overlap, so wall time adds up past elapsed time
+    with stage("lookup"):
+        results = await asyncio.gather(*(lookup(chunk, cap) for chunk, cap in chunks))
+    profiling.count(
+        roundTrips=len(chunks),
+        rowsFetched=sum(len(rows) for res in results for rows in res.values()),
+    )
+
+    for (_, cap), res in zip(chunks, results):
+        for address, rows in res.items():
+            reads[address] = np.array([c for _, c in rows], dtype=np.int64)
+            if cache is not None and cap is None:
+                cache.put(address, reads[address])
+
+    countStat(stats, "lookups", len(addresses) + len(capped))
+    return reads
+
+
+async def searchFileAsync(
+    pool,
+    filename,
+    cutoff=0.50,
+    verbose=False,
+    coherencyTol=0.1,
+    coeff=COHERENCY_COEFF,
+    timeFreqTol=(0.1, 0.1),
+    topK=TOP_K,
+    minHits=MIN_HITS,
+    start=None,
+    duration=MAX_QUERY_SECONDS,
+    bloom=None,
+    cache=None,
+    resultCache=None,
+    stopPolicy=None,
+    config=None,
+    stats=None,
+    executor=None,
+    poolSize=POOL_SIZE,
+):
+    loop = asyncio.get_running_loop()
+
+    # ffmpeg and the DSP chain run off the event loop so other searches keep querying
+    if resultCache is None:
+        addressCouple = await loop.run_in_executor(
+            executor,
+            fingerprintFile,
+            pool.conninfo,
+            filename,
+            verbose,
+            start,
+            duration,
+            config,
+        )
+    else:
+        info = await loop.run_in_executor(
+            executor, decodeQuery, filename, verbose, start, duration
+        )
+        await checkVersionAsync(pool, resultCache)
+        key = searchKey(
+            pool.conninfo,
+            info,
+            "search",
+            cutoff=cutoff,
+            coherencyTol=coherencyTol,
+            coeff=coeff,
+            timeFreqTol=timeFreqTol,
+            topK=topK,
+            minHits=minHits,
+            config=config,
+            stopPolicy=stopPolicy,
+        )
+        res = resultCache.get(key)
+        countStat(stats, "resultCacheMisses" if res is MISS else "resultCacheHits", 1)
+        if res is not MISS:
+            return res
+
+        addressCouple = await loop.run_in_executor(
+            executor, fingerprintQuery, pool.conninfo, info, config
+        )
+    numTargetZones = len(addressCouple)
+
+    if verbose:
+        print(f"Number of target zones: {numTargetZones}")
+
+    codec = configCodec(config)
+    encoded = [codec.encodeAddress(address) for address, _ in addressCouple]
+    reads = await lookupAddressesAsync(
+        pool,
+        encoded,
+        poolSize=poolSize,
+        stats=stats,
+        bloom=bloom,
+        cache=cache,
+        stopPolicy=stopPolicy,
+    )
+
+    foundTones = {}
+    foundDB = {}
+    for (_, couple), address in zip(addressCouple, encoded):
+        read = reads[address]
+        if len(read) == 0:
+            continue
+
+        addMatches(
+            foundTones,
+            foundDB,
+            address,
+            couple,
+            read,
+            timeFreqTol,
+            weight=stopWeight(stopPolicy, address),
+            codec=codec,
+        )
+
+    res = await loop.run_in_executor(
+        None,
+        rankMatches,
+        addressCouple,
+        foundDB,
+        foundTones,
+        getToneCache(pool.conninfo),
+        numTargetZones,
+        cutoff,
+        verbose,
+        coherencyTol,
+        coeff,
+        topK,
+        minHits,
+    )
+    if resultCache is not None:
+        resultCache.put(key, res)
+    return res
+
+
+async def searchFilesAsync(
+    db, filenames, poolSize=POOL_SIZE, maxDecoders=MAX_DECODERS, **kwargs
+):
+    toneNames = getToneCache(db)
+    if not toneNames.loaded:
+        await asyncio.to_thread(toneNames.load)
+    with sql.connect(db) as conn:
+        checkConfig(conn, kwargs.get("config"))
+        checkShards(conn, None)
+
+    # All searches start at once, so the decode of one file overlaps the lookups of another
+    async with AsyncConnectionPool(
+        db, min_size=1, max_size=poolSize, open=False
+    ) as pool:
+        with ProcessPoolExecutor(max_workers=maxDecoders) as exec:
+            return await asyncio.gather(
+                *(
+                    searchFileAsync(
+                        pool, filename, executor=exec, poolSize=poolSize, **kwargs
+                    )
+                    for filename in filenames
+                )
+            )
@@ -1,22 +1,40 @@
 from concurrent.futures.process import ProcessPoolExecutor
 from pathlib import Path
 from typing import Counter
+from contextlib import contextmanager
+import numpy as np
 import psycopg as sql
 
 from db_utils import (
     doesToneExist,
     storeTone,
-    storeAddressCouple,
-    readAddressCoupleFromAddress,
-    readTone,
+    storeEncodedCouples,
+    scoreOffsetHistogram,
+    readAddressCouplesFromAddresses,
+    readCatalogVersion,
+    readAddressCouplesCapped,
+    readPackedPostings,
+    checkConfig,
 )
-from audio_utils import genToneId, getAudioInfo, processAudiofile
+from stopwords import capStopCouples, splitStopAddresses
+from scoring import DELTA_BIN_MS, OffsetHistogram, isConfident
+from caches import MISS, getToneCache, resultKey
+from bloom import BLOOM_PATH
+from audio_utils import audioHash, genToneId, getAudioInfo, processAudiofile
 from audio_proc import printInfo
-from codec import (
-    decodeAddress32Bit,
-    decodeCouple64Bit,
-    encodeAddress32Bit,
+from codec import DEFAULT_CODEC, encodeCouple64Bit, unpackCouples
+from artifacts import (
+    Artifact,
+    listArtifacts,
+    loadArtifact,
+    readArtifact,
+    writeArtifact,
 )
+from constellation import configCodec
+from shards import checkShards, getShardPool
+from snapshot import getSnapshot
+import profiling
+from profiling import stage
 from multiprocessing import Queue
 
 # from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -25,40 +43,143 @@ from concurrent.futures import as_completed
 TARGET_RES = 200
 # TARGET_RES = 10.7
 
+# Queries are cut to this many seconds unless a duration is given, 0 decodes it all
+MAX_QUERY_SECONDS = 30
 
-def loadFile(db, filename, verbose=False):
+AUDIO_SUFFIXES = [".wav", ".mp3", ".flac"]
+
+# Progressive search looks addresses up in slices of SLICE_MS of query time
+SLICE_MS = 1000
+CONFIDENCE_MARGIN = 2.0
+
+# Only the TOP_K songs with at least MIN_HITS raw hits get the full coherency check.
+# Short or noisy queries give the right song only a few hits, raise the floor only
+# once bench.py shows recall does not drop
+TOP_K = 10
+MIN_HITS = 1
+
+# A match needs coherent hits on at least this share of the query's target zones,
+# whichever way the offsets are counted
+COHERENCY_COEFF = 0.5
+
+EMPTY_POSTING = np.zeros(0, dtype=np.int64)
+
+
+def fingerprintTone(db, info, toneId, toneName, verbose=False, config=None):
+    addressCouple = processAudiofile(info, db, toneId, verbose=verbose, config=config)
+    codec = configCodec(config)
+    return Artifact(
+        toneId,
+        toneName,
+        np.array([codec.encodeAddress(a) for a, _ in addressCouple], dtype=np.int64),
+        np.array([encodeCouple64Bit(c) for _, c in addressCouple], dtype=np.int64),
+    )
+
+
+def storeArtifact(conn, artifact, bloomPath=BLOOM_PATH, stopPolicy=None, shards=None):
+    if doesToneExist(conn, artifact.toneId):
+        return f"Tone {artifact.toneId} already exists in database"
+
+    # Stop addresses are skipped, capped or counted on the way in as well, so the
+    # index only grows by what searches will read
+    addresses, couples = artifact.addresses, artifact.couples
+    stopAddresses = None
+    if stopPolicy is not None and stopPolicy.dfs:
+        if stopPolicy.action == "skip":
+            stopAddresses = stopPolicy.dfs
+        else:
+            addresses, couples = capStopCouples(conn, addresses, couples, stopPolicy)
+    with stage("store"):
+        if shards is None:
+            storeEncodedCouples(
+                conn,
+                addresses,
+                couples,
+                bloomPath=bloomPath,
+                stopAddresses=stopAddresses,
+            )
+        else:
+            shards.store(addresses, couples, bloomPath, stopAddresses)
+    try:
+        storeTone(conn, artifact.toneId, artifact.name)
+    except Exception as e:
+        return f"Error: {e}"
+    return f"Stored address-couple pairs in database for tone_id: {artifact.toneId}"
+
+
+def loadFile(
+    db,
+    filename,
+    verbose=False,
+    bloomPath=BLOOM_PATH,
+    stopPolicy=None,
+    config=None,
+    artifactDir=None,
+    shards=None,
+):
     print(f"Loading file: {filename}")
-    info = getAudioInfo(filename)
-    if verbose:
-        printInfo(info)
-    path: Path = Path(filename).resolve()
+    # Fingerprints cached from an earlier load skip ffmpeg and the DSP chain
+    artifact = readArtifact(artifactDir, filename, config)
 
-    # Generate max 32bit integer for toneId using the first 32 bits of the hash of the audio data
-    toneId = genToneId(info)
     with sql.connect(db) as conn:
-        if doesToneExist(conn, toneId):
-            return f"Tone {toneId} already exists in database"
-
-        addressCouple = processAudiofile(
-            info, db, toneId, verbose=verbose, targetRes=TARGET_RES
+        checkConfig(conn, config, store=True)
+        checkShards(conn, shards, store=True)
+        if artifact is None:
+            info = getAudioInfo(filename)
+            if verbose:
+                printInfo(info)
+            path: Path = Path(filename).resolve()
+
+            # Generate max 32bit integer for toneId using the first 32 bits of the hash of the audio data
+            toneId = genToneId(info)
+            if doesToneExist(conn, toneId):
+                return f"Tone {toneId} already exists in database"
+
+            artifact = fingerprintTone(db, info, toneId, path.stem, verbose, config)
+            writeArtifact(artifactDir, filename, config, artifact)
+
+        return storeArtifact(
+            conn, artifact, bloomPath, stopPolicy, getShardPool(shards)
         )
-        toneName = path.stem
-        storeAddressCouple(conn, addressCouple)
-        try:
-            storeTone(conn, toneId, toneName)
-        except Exception as e:
-            return f"Error: {e}"
-        return f"Stored address-couple pairs in database for tone_id: {toneId}"
 
 
-def findFiles(foldername: Path, fileQueue: Queue):
+def loadArtifacts(
+    db, artifactDir, bloomPath=BLOOM_PATH, stopPolicy=None, config=None, shards=None
+):
+    # Rebuilds an index from cached fingerprints alone, no source file is read
+    paths = listArtifacts(artifactDir, config)
+    pool = getShardPool(shards)
+    with sql.connect(db) as conn:
+        checkConfig(conn, config, store=True)
+        checkShards(conn, shards, store=True)
+        for path in paths:
+            print(storeArtifact(conn, loadArtifact(path), bloomPath, stopPolicy, pool))
+    return len(paths)
+
+
+def listAudioFiles(foldername: Path):
     for file in foldername.rglob("*"):
-        if file.is_file() and file.suffix in [".wav", ".mp3", ".flac"]:
-            print(f"Found: {file}")
-            fileQueue.put(file)
+        if file.is_file() and file.suffix in AUDIO_SUFFIXES:
+            yield file
+
+
+def findFiles(foldername: Path, fileQueue: Queue):
+    for file in listAudioFiles(foldername):
+        print(f"Found: {file}")
+        fileQueue.put(file)
 
 
-def loadFolders(db, foldername, maxWorkers=6, verbose=False):
+def loadFolders(
+    db,
+    foldername,
+    maxWorkers=6,
+    verbose=False,
+    bloomPath=BLOOM_PATH,
+    stopPolicy=None,
+    config=None,
+    artifactDir=None,
+    shards=None,
+):
     fileQueue = Queue()
     findFiles(foldername, fileQueue)
     failed = 0
@@ -70,12 +191,28 @@ def loadFolders(db, foldername, maxWorkers=6, verbose=False):
                 todo = {}
                 while not fileQueue.empty():
                     file = fileQueue.get()
-                    future = exec.submit(loadFile, db, str(file), verbose)
+                    args = (
+                        db,
+                        str(file),
+                        verbose,
+                        bloomPath,
+                        stopPolicy,
+                        config,
+                        artifactDir,
+                        shards,
+                    )
+                    if profiling.enabled():
+                        future = exec.submit(profiling.profiled, loadFile, *args)
+                    else:
+                        future = exec.submit(loadFile, *args)
                     todo[future] = str(file)
                 for job in as_completed(todo):
                     file = todo[job]
                     try:
                         res = job.result()
+                        if profiling.enabled():
+                            res, report = res
+                            profiling.merge(report)
                         print(res)
                     except (ZeroDivisionError, IndexError) as e:
                         failed += 1
@@ -125,8 +262,9 @@ def tryCoherency(
     addressCouple,
     foundDB,
     foundTones,
+    toneNames,
     numTargetZones,
-    coeff=0.5,
+    coeff=COHERENCY_COEFF,
     verbose=False,
     tol=0.1,
 ):
@@ -137,7 +275,7 @@ def tryCoherency(
         if not maxTime:
             continue
         if verbose:
-            print(f"{foundTones[id]["tone"][1]} : {maxTime}")
+            print(f"{toneNames.name(id)} : {maxTime}")
 
         if maxTime[1] > maxCoherency:
             maxCoherency = maxTime[1]
@@ -145,29 +283,30 @@ def tryCoherency(
 
     if maxCoherency >= numTargetZones * coeff:
         if verbose:
-            print(f"Best match: {foundTones[bestSong]["tone"][1]}")
-        return foundTones[bestSong]["tone"][1]
+            print(f"Best match: {toneNames.name(bestSong)}")
+        return toneNames.name(bestSong)
     else:
         if verbose:
             print("No tone met coherency threshold")
         return None
 
 
-def tryMatchRatios(foundTones, numTargetZones, cutoff, verbose=False):
-    filtered = []
-    tonesWithMatchRatios = {}
-    for id, data in foundTones.items():
-        matchRatio = data["common"] / numTargetZones
-        tonesWithMatchRatios[id] = (data["tone"][1], matchRatio)
-        if matchRatio >= cutoff:
-            filtered.append((data["tone"][1], matchRatio))
+def tryMatchRatios(foundTones, toneNames, numTargetZones, cutoff, verbose=False):
+    # Names are only resolved for the tones that end up in the result
+    matchRatios = {
+        id: data["common"] / numTargetZones for id, data in foundTones.items()
+    }
+    filtered = [
+        (toneNames.name(id), matchRatio)
+        for id, matchRatio in matchRatios.items()
+        if matchRatio >= cutoff
+    ]
 
     if not filtered:
         if verbose:
             print("Tone not found with the given cutoff ouputting top 5 matches")
-        top5 = sorted(tonesWithMatchRatios.values(), key=lambda x: x[1], reverse=True)[
-            :5
-        ]
+        top5 = sorted(matchRatios.items(), key=lambda x: x[1], reverse=True)[:5]
+        top5 = [(toneNames.name(id), matchRatio) for id, matchRatio in top5]
 
         if verbose:
             print("Top 5 matches:")
@@ -181,21 +320,204 @@ def tryMatchRatios(foundTones, numTargetZones, cutoff, verbose=False):
     return filtered
 
 
+def countStat(stats, key, n):
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + n
+
+
+def skipMisses(addresses, bloom, stats=None):
+    # Addresses the bloom filter rules out cannot have a posting list
+    if bloom is None or not addresses:
+        return addresses
+    maybe = bloom.contains(addresses)
+    countStat(stats, "skipped", len(addresses) - int(maybe.sum()))
+    return [address for address, keep in zip(addresses, maybe) if keep]
+
+
+def decodeQuery(filename, verbose=False, start=None, duration=MAX_QUERY_SECONDS):
+    info = getAudioInfo(filename, start=start, duration=duration)
+
+    if verbose:
+        printInfo(info)
+
+    return info
+
+
+def fingerprintQuery(db, info, config=None):
+    return processAudiofile(info, db, toneId=0, config=config)
+
+
+def fingerprintFile(
+    db, filename, verbose=False, start=None, duration=MAX_QUERY_SECONDS, config=None
+):
+    info = decodeQuery(filename, verbose, start, duration)
+    return fingerprintQuery(db, info, config=config)
+
+
+def searchKey(db, info, mode, stopPolicy=None, shards=None, snapshot=None, **params):
+    # Besides the query and parameters, a result depends on where the catalog is
+    # served from and on the stop list it is filtered with
+    return resultKey(
+        audioHash(info),
+        mode,
+        db=db,
+        shards=list(shards or []),
+        snapshot=None if snapshot is None else (snapshot, getSnapshot(snapshot).digest),
+        stopPolicy=None if stopPolicy is None else stopPolicy.identity(),
+        **params,
+    )
+
+
+def cachedResult(db, resultCache, info, mode, stats=None, **params):
+    # Returns the result cache key and the cached result, MISS when it has to be searched
+    if resultCache is None:
+        return None, MISS
+
+    if resultCache.due():
+        with sql.connect(db) as conn:
+            resultCache.checkVersion(readCatalogVersion(conn))
+
+    key = searchKey(db, info, mode, **params)
+    res = resultCache.get(key)
+    countStat(stats, "resultCacheMisses" if res is MISS else "resultCacheHits", 1)
+    return key, res
+
+
+def stopWeight(stopPolicy, address):
+    return 1 if stopPolicy is None else stopPolicy.weight(address)
+
+
+def addMatches(
+    foundTones,
+    foundDB,
+    address,
+    couple,
+    couples,
+    timeFreqTol,
+    weight=1,
+    codec=DEFAULT_CODEC,
+):
+    # Every couple in a posting list shares the looked up address, so isMatchingZone's
+    # frequency test always passes and only anchor times are compared
+    a = codec.decodeAddress(address)
+    couples = np.asarray(couples, dtype=np.int64)
+    if len(couples) == 0:
+        return
+    times = (couples >> 32) & 0xFFFFFFFF
+    ids = couples & 0xFFFFFFFF
+    matching = np.abs(couple[0] - times) <= timeFreqTol[0]
+
+    # Songs in order of first appearance, as the per-couple loop added them
+    songs, first, hits = np.unique(ids, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    for id, n in zip(songs[order].tolist(), hits[order].tolist()):
+        if id not in foundTones:
+            foundTones[id] = {"common": 0, "hits": 0}
+            foundDB[id] = []
+        foundTones[id]["hits"] += weight * n
+
+    for id, t in zip(ids[matching].tolist(), times[matching].tolist()):
+        foundTones[id]["common"] += weight
+        foundDB[id].append((a, (t, id)))
+
+
+def pruneCandidates(foundTones, foundDB, topK=TOP_K, minHits=MIN_HITS):
+    candidates = sorted(
+        (id for id, data in foundTones.items() if data["hits"] >= minHits),
+        key=lambda id: foundTones[id]["hits"],
+        reverse=True,
+    )[:topK]
+    return (
+        {id: foundTones[id] for id in candidates},
+        {id: foundDB[id] for id in candidates},
+    )
+
+
+def rankMatches(
+    addressCouple,
+    foundDB,
+    foundTones,
+    toneNames,
+    numTargetZones,
+    cutoff=0.50,
+    verbose=False,
+    coherencyTol=0.1,
+    coeff=COHERENCY_COEFF,
+    topK=TOP_K,
+    minHits=MIN_HITS,
+):
+    # Cheap first stage: the hit count decides who is worth the coherency check
+    prunedTones, prunedDB = pruneCandidates(foundTones, foundDB, topK, minHits)
+    if verbose:
+        print(f"Scoring {len(prunedTones)} of {len(foundTones)} candidate tones")
+
+    with stage("coherency"):
+        coherencyRes = tryCoherency(
+            addressCouple,
+            prunedDB,
+            prunedTones,
+            toneNames,
+            numTargetZones,
+            verbose=verbose,
+            coeff=coeff,
+            tol=coherencyTol,
+        )
+    if coherencyRes:
+        return coherencyRes
+
+    # The fallback ranks every candidate, as before pruning
+    matchRatioRes = tryMatchRatios(
+        foundTones, toneNames, numTargetZones, cutoff, verbose=verbose
+    )
+    if matchRatioRes:
+        return matchRatioRes
+
+    return None
+
+
 def searchFile(
     db,
     filename,
     cutoff=0.50,
     verbose=False,
     coherencyTol=0.1,
-    coeff=0.5,
+    coeff=COHERENCY_COEFF,
     timeFreqTol=(0.1, 0.1),
+    topK=TOP_K,
+    minHits=MIN_HITS,
+    start=None,
+    duration=MAX_QUERY_SECONDS,
+    bloom=None,
+    cache=None,
+    resultCache=None,
+    stopPolicy=None,
+    config=None,
+    stats=None,
+    shards=None,
+    snapshot=None,
 ):
-    info = getAudioInfo(filename)
-
-    if verbose:
-        printInfo(info)
+    info = decodeQuery(filename, verbose=verbose, start=start, duration=duration)
+    key, res = cachedResult(
+        db,
+        resultCache,
+        info,
+        "search",
+        stats=stats,
+        cutoff=cutoff,
+        coherencyTol=coherencyTol,
+        coeff=coeff,
+        timeFreqTol=timeFreqTol,
+        topK=topK,
+        minHits=minHits,
+        config=config,
+        stopPolicy=stopPolicy,
+        shards=shards,
+        snapshot=snapshot,
+    )
+    if res is not MISS:
+        return res
 
-    addressCouple = processAudiofile(info, db, toneId=0, targetRes=TARGET_RES)
+    addressCouple = fingerprintQuery(db, info, config=config)
     numTargetZones = len(addressCouple)
 
     if verbose:
@@ -203,6 +525,20 @@ def searchFile(
 
     foundTones = {}
     foundDB = {}
+    codec = configCodec(config)
+
+    served = getSnapshot(snapshot)
+    with openCatalog(db, config, shards, served) as conn:
+        reads = lookupAddresses(
+            conn,
+            [codec.encodeAddress(address) for address, _ in addressCouple],
+            stats=stats,
+            bloom=bloom,
+            cache=cache,
+            stopPolicy=stopPolicy,
+            shards=getShardPool(shards),
+            snapshot=served,
+        )
 
     # Find the matching couples in the database for all fingerprints
     for address, couple in addressCouple:
@@ -210,44 +546,395 @@ def searchFile(
             print(f"Searching for: {address}")
             print(f"Encoded: {address}")
 
-        address = encodeAddress32Bit(address)
-        read = readAddressCoupleFromAddress(db, address)
-        if not read:
+        address = codec.encodeAddress(address)
+        read = reads[address]
+        if len(read) == 0:
             continue
 
-        address = decodeAddress32Bit(address)
-
-        for a, c in read:
-            c = decodeCouple64Bit(c)
-            a = decodeAddress32Bit(a)
-            id = c[1]
-            tone = readTone(db, id)
-
-            if id not in foundTones:
-                foundTones[id] = {"tone": tone, "common": 0}
-                foundDB[id] = []
-
-            if isMatchingZone(couple, c, address, a, timeFreqTol=timeFreqTol):
-                foundTones[id]["common"] += 1
-                foundDB[id].append((a, c))
+        addMatches(
+            foundTones,
+            foundDB,
+            address,
+            couple,
+            read,
+            timeFreqTol,
+            weight=stopWeight(stopPolicy, address),
+            codec=codec,
+        )
 
-    coherencyRes = tryCoherency(
+    res = rankMatches(
         addressCouple,
         foundDB,
         foundTones,
+        served or getToneCache(db),
         numTargetZones,
+        cutoff=cutoff,
         verbose=verbose,
+        coherencyTol=coherencyTol,
         coeff=coeff,
-        tol=coherencyTol,
+        topK=topK,
+        minHits=minHits,
     )
-    if coherencyRes:
-        return coherencyRes
+    if resultCache is not None:
+        resultCache.put(key, res)
+    return res
 
-    matchRatioRes = tryMatchRatios(foundTones, numTargetZones, cutoff, verbose=verbose)
-    if matchRatioRes:
-        return matchRatioRes
 
-    return None
+def rankOffsetScores(
+    scores, toneNames, numTargetZones, cutoff=0.50, coeff=COHERENCY_COEFF, verbose=False
+):
+    # scores are (songId, coherency) pairs sorted by coherency, best first
+    if not scores:
+        if verbose:
+            print("No tone shares a fingerprint with the query")
+        return None
+
+    bestSong, maxCoherency = scores[0]
+    if maxCoherency >= numTargetZones * coeff:
+        if verbose:
+            print(f"Best match: {toneNames.name(bestSong)} : {maxCoherency}")
+        return toneNames.name(bestSong)
+
+    if verbose:
+        print("No tone met coherency threshold")
+
+    matchRatios = [(id, coherency / numTargetZones) for id, coherency in scores]
+    filtered = [(id, ratio) for id, ratio in matchRatios if ratio >= cutoff]
+    if not filtered:
+        filtered = matchRatios[:5]
+
+    res = [(toneNames.name(id), ratio) for id, ratio in filtered]
+    if verbose:
+        for tone, matchRatio in res:
+            print(f"{tone}: {matchRatio:.5%}")
+    return tuple(res)
+
+
+def searchFileSQL(
+    db,
+    filename,
+    cutoff=0.50,
+    verbose=False,
+    coeff=COHERENCY_COEFF,
+    topK=TOP_K,
+    minHits=MIN_HITS,
+    deltaBin=DELTA_BIN_MS,
+    start=None,
+    duration=MAX_QUERY_SECONDS,
+    bloom=None,
+    resultCache=None,
+    stopPolicy=None,
+    config=None,
+    stats=None,
+):
+    info = decodeQuery(filename, verbose=verbose, start=start, duration=duration)
+    key, res = cachedResult(
+        db,
+        resultCache,
+        info,
+        "search_sql",
+        stats=stats,
+        cutoff=cutoff,
+        coeff=coeff,
+        topK=topK,
+        minHits=minHits,
+        deltaBin=deltaBin,
+        config=config,
+        stopPolicy=stopPolicy,
+    )
+    if res is not MISS:
+        return res
+
+    addressCouple = fingerprintQuery(db, info, config=config)
+    numTargetZones = len(addressCouple)
+
+    if verbose:
+        print(f"Number of target zones: {numTargetZones}")
+
+    # Only the query's (address, anchorTime) arrays go up and the top K come back
+    codec = configCodec(config)
+    addresses = [codec.encodeAddress(address) for address, _ in addressCouple]
+    anchorTimes = [int(couple[0]) for _, couple in addressCouple]
+
+    # Stop addresses are left out whatever the policy, the join cannot cap or weigh them
+    maybe = set(skipMisses(list(set(addresses)), bloom, stats=stats))
+    if stopPolicy is not None and stopPolicy.dfs:
+        stops = maybe & stopPolicy.dfs.keys()
+        countStat(stats, "stopAddresses", len(stops))
+        maybe -= stops
+    if bloom is not None or stopPolicy is not None:
+        kept = [(a, t) for a, t in zip(addresses, anchorTimes) if a in maybe]
+        addresses = [a for a, _ in kept]
+        anchorTimes = [t for _, t in kept]
+    countStat(stats, "lookups", len(maybe))
+    with sql.connect(db) as conn:
+        checkConfig(conn, config)
+        # The join runs in one database, a sharded store has no couples here
+        checkShards(conn, None)
+        with stage("histogram"):
+            rows = scoreOffsetHistogram(
+                conn, addresses, anchorTimes, topK, minHits=minHits, deltaBin=deltaBin
+            )
+        profiling.count(roundTrips=1, rowsFetched=len(rows))
+
+    if verbose:
+        for songId, delta, coherency, hits in rows:
+            print(f"{songId} : delta {delta} ms, coherency {coherency}, hits {hits}")
+
+    res = rankOffsetScores(
+        [(songId, coherency) for songId, _, coherency, _ in rows],
+        getToneCache(db),
+        numTargetZones,
+        cutoff=cutoff,
+        coeff=coeff,
+        verbose=verbose,
+    )
+    if resultCache is not None:
+        resultCache.put(key, res)
+    return res
+
+
+def cachedAddresses(addresses, reads, cache, stats=None):
+    # Fills reads from the posting cache and returns the addresses still to fetch
+    if cache is None:
+        return addresses
+
+    misses = []
+    for address in addresses:
+        couples = cache.get(address)
+        if couples is None:
+            misses.append(address)
+        else:
+            reads[address] = couples
+    countStat(stats, "cacheHits", len(addresses) - len(misses))
+    countStat(stats, "cacheMisses", len(misses))
+    return misses
+
+
+@contextmanager
+def openCatalog(db, config, shards=None, snapshot=None):
+    # A connection checked against the query's config, None when a snapshot serves it
+    if snapshot is not None:
+        snapshot.checkConfig(config)
+        yield None
+        return
+    with sql.connect(db) as conn:
+        checkConfig(conn, config)
+        checkShards(conn, shards)
+        yield conn
+
+
+def fetchPostings(conn, addresses, capped=(), cap=None):
+    # Appended (address, couple) rows and packed posting bytes of one database
+    rows = []
+    packed = {}
+    if addresses:
+        rows += readAddressCouplesFromAddresses(conn, addresses)
+        packed = dict(readPackedPostings(conn, addresses))
+    if capped:
+        rows += readAddressCouplesCapped(conn, capped, cap)
+    return rows, packed
+
+
+def lookupAddresses(
+    conn,
+    addresses,
+    stats=None,
+    bloom=None,
+    cache=None,
+    stopPolicy=None,
+    shards=None,
+    snapshot=None,
+):
+    addresses = list(set(addresses))
+    reads = {address: EMPTY_POSTING for address in addresses}
+
+    if snapshot is not None:
+        # Postings are slices of the mapped file already, there is nothing to cache,
+        # and a bloom filter over the database could rule out addresses it has
+        cache = None
+        bloom = None
+    if cache is not None and cache.due():
+        cache.checkVersion(readCatalogVersion(conn))
+
+    addresses = skipMisses(addresses, bloom, stats=stats)
+    addresses, capped = splitStopAddresses(addresses, stopPolicy, stats=stats)
+    # The cache only holds whole posting lists, capped reads always go to the store
+    addresses = cachedAddresses(addresses, reads, cache, stats=stats)
+    if snapshot is not None:
+        with stage("lookup"):
+            reads.update(snapshot.postings(addresses))
+            if capped:
+                reads.update(snapshot.postings(capped, stopPolicy.cap))
+    elif addresses or capped:
+        fetched = {address: [] for address in addresses + capped}
+        cap = stopPolicy.cap if capped else None
+        with stage("lookup"):
+            if shards is None:
+                rows, packed = fetchPostings(conn, addresses, capped, cap)
+                roundTrips = 2 * bool(addresses) + bool(capped)
+            else:
+                # Each shard holds whole posting lists, so their rows just add up
+                parts = shards.split(addresses)
+                cappedParts = shards.split(capped)
+                rows = []
+                packed = {}
+                for shardRows, shardPacked in shards.fanOut(
+                    fetchPostings, parts, cappedParts, [cap] * len(parts)
+                ):
+                    rows += shardRows
+                    packed.update(shardPacked)
+                roundTrips = sum(
+                    2 * bool(a) + bool(c) for a, c in zip(parts, cappedParts)
+                )
+        profiling.count(
+            roundTrips=roundTrips,
+            rowsFetched=len(rows) + len(packed),
+            bytesDecoded=sum(len(p) for p in packed.values()),
+        )
+
+        for address, couple in rows:
+            fetched[address].append(couple)
+        cappedSet = set(capped)
+        for address, couples in fetched.items():
+            reads[address] = np.array(couples, dtype=np.int64)
+            if address in packed:
+                reads[address] = np.concatenate(
+                    [unpackCouples(packed[address]), reads[address]]
+                )
+            if cache is not None and address not in cappedSet:
+                cache.put(address, reads[address])
+
+    countStat(stats, "lookups", len(addresses) + len(capped))
+    return reads
+
+
+def timeSlices(addressCouple, sliceMs=SLICE_MS):
+    ordered = sorted(addressCouple, key=lambda ac: ac[1][0])
+    current = []
+    sliceEnd = None
+    for address, couple in ordered:
+        if sliceEnd is None:
+            sliceEnd = couple[0] + sliceMs
+        if couple[0] >= sliceEnd:
+            yield current
+            current = []
+            sliceEnd = couple[0] + sliceMs
+        current.append((address, couple))
+    if current:
+        yield current
+
+
+def searchFileProgressive(
+    db,
+    filename,
+    cutoff=0.50,
+    verbose=False,
+    coeff=COHERENCY_COEFF,
+    topK=TOP_K,
+    minHits=MIN_HITS,
+    deltaBin=DELTA_BIN_MS,
+    sliceMs=SLICE_MS,
+    margin=CONFIDENCE_MARGIN,
+    stats=None,
+    start=None,
+    duration=MAX_QUERY_SECONDS,
+    bloom=None,
+    cache=None,
+    resultCache=None,
+    stopPolicy=None,
+    config=None,
+    shards=None,
+    snapshot=None,
+):
+    info = decodeQuery(filename, verbose=verbose, start=start, duration=duration)
+    key, res = cachedResult(
+        db,
+        resultCache,
+        info,
+        "search_progressive",
+        stats=stats,
+        cutoff=cutoff,
+        coeff=coeff,
+        topK=topK,
+        minHits=minHits,
+        deltaBin=deltaBin,
+        sliceMs=sliceMs,
+        margin=margin,
+        config=config,
+        stopPolicy=stopPolicy,
+        shards=shards,
+        snapshot=snapshot,
+    )
+    if res is not MISS:
+        return res
+
+    addressCouple = fingerprintQuery(db, info, config=config)
+    numTargetZones = len(addressCouple)
+    codec = configCodec(config)
+    totalLookups = len({codec.encodeAddress(address) for address, _ in addressCouple})
+
+    if verbose:
+        print(f"Number of target zones: {numTargetZones}")
+
+    if stats is None:
+        stats = {}
+    stats["lookups"] = 0
+
+    histogram = OffsetHistogram(deltaBin)
+    reads = {}
+    processed = 0
+    pool = getShardPool(shards)
+    served = getSnapshot(snapshot)
+    with openCatalog(db, config, shards, served) as conn:
+        for slice in timeSlices(addressCouple, sliceMs):
+            encoded = [codec.encodeAddress(address) for address, _ in slice]
+            reads.update(
+                lookupAddresses(
+                    conn,
+                    [a for a in encoded if a not in reads],
+                    stats=stats,
+                    bloom=bloom,
+                    cache=cache,
+                    stopPolicy=stopPolicy,
+                    shards=pool,
+                    snapshot=served,
+                )
+            )
+
+            for address, (_, couple) in zip(encoded, slice):
+                histogram.add(
+                    couple[0], reads[address], weight=stopWeight(stopPolicy, address)
+                )
+            processed += len(slice)
+
+            leaders = histogram.leaders(2, minHits=minHits)
+            if isConfident(leaders, processed, coeff, margin, minHits=minHits):
+                if verbose:
+                    print(f"Confident after {processed} of {numTargetZones} zones")
+                break
+
+    # reads has every address of the processed slices, whether it was fetched, skipped
+    # by the bloom filter or served from the cache, the rest were never needed
+    stats["totalLookups"] = totalLookups
+    stats["lookupsSaved"] = totalLookups - len(reads)
+    if verbose:
+        print(
+            f"Lookups: {stats['lookups']} of {totalLookups}, bloom skipped {stats.get('skipped', 0)}, "
+            f"cached {stats.get('cacheHits', 0)}, saved by stopping early {stats['lookupsSaved']}"
+        )
+
+    res = rankOffsetScores(
+        histogram.leaders(topK, minHits=minHits),
+        served or getToneCache(db),
+        processed,
+        cutoff=cutoff,
+        coeff=coeff,
+        verbose=verbose,
+    )
+    if resultCache is not None:
+        resultCache.put(key, res)
+    return res
 
 
 def searchFileN(db, filename, cutoff=0.50, n=3):
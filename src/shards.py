@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+import json
+import numpy as np
+import psycopg as sql
+
+from bloom import BLOOM_PATH, mix64
+from db_utils import createMeta, readMeta, storeEncodedCouples
+
+# Salted so shard routing is independent of the bloom filter's bit positions
+SHARD_SALT = np.uint64(0x2545F4914F6CDD1D)
+
+
+class ShardMismatch(ValueError):
+    pass
+
+
+def shardOf(addresses, numShards):
+    addresses = np.asarray(addresses, dtype=np.int64).astype(np.uint64)
+    return (mix64(addresses ^ SHARD_SALT) % np.uint64(numShards)).astype(np.int64)
+
+
+def shardLayout(dsns):
+    # The shard count and a digest of the ordered DSNs, not the DSNs themselves since
+    # they can hold passwords
+    dsns = list(dsns or [])
+    digest = sha256("\n".join(dsns).encode()).hexdigest()
+    return {"count": len(dsns), "digest": digest}
+
+
+def storeMeta(conn, key, value):
+    with conn.cursor() as cursor:
+        createMeta(cursor)
+        cursor.execute(
+            "INSERT INTO meta (key, value) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            [key, value],
+        )
+    conn.commit()
+
+
+def checkShards(conn, dsns, store=False):
+    # Addresses only route to the same shard with the same shards in the same order.
+    # The catalog records the layout and every shard its place in it
+    layout = shardLayout(dsns)
+    if store:
+        storeMeta(conn, "shards", json.dumps(layout))
+
+    found = readMeta(conn, "shards")
+    if found is not None:
+        found = json.loads(found)
+        # Catalogs from before the layout was stored only recorded the count
+        if isinstance(found, int):
+            found = {"count": found, "digest": layout["digest"]}
+        if found["count"] != layout["count"]:
+            raise ShardMismatch(
+                f"Database has {found['count']} shards, not {layout['count']}"
+            )
+        if found != layout:
+            raise ShardMismatch(
+                "Database was sharded over other DSNs or in another order"
+            )
+
+    # Shards are checked once per process, and once more if that check did not store
+    pool = getShardPool(dsns)
+    if pool is None or pool.checked is not None and pool.checked >= store:
+        return
+    for i, shardConn in enumerate(pool.conns):
+        place = json.dumps({"index": i, **layout})
+        if store:
+            storeMeta(shardConn, "shard", place)
+        found = readMeta(shardConn, "shard")
+        if found is not None and json.loads(found) != json.loads(place):
+            found = json.loads(found)
+            raise ShardMismatch(
+                f"Shard {i} was stored as shard {found['index']} of {found['count']}"
+                " of another shard list"
+            )
+    pool.checked = store
+
+
+class ShardPool:
+    """
+    Fingerprint tables split by address hash over one database or schema per DSN.
+    The tone, meta and stop_address tables stay in the catalog database. Every
+    shard has its own connection and lookup thread, so a query's round trips run
+    side by side.
+    """
+
+    def __init__(self, dsns):
+        self.dsns = list(dsns)
+        self.conns = [sql.connect(dsn) for dsn in self.dsns]
+        # Whether checkShards has matched, or stored, every shard's place in the list
+        self.checked = None
+        self.executor = ThreadPoolExecutor(max_workers=len(self.dsns))
+
+    def split(self, addresses):
+        # Addresses of every shard, in shard order
+        addresses = np.asarray(addresses, dtype=np.int64)
+        shard = shardOf(addresses, len(self.dsns))
+        return [addresses[shard == i].tolist() for i in range(len(self.dsns))]
+
+    def fanOut(self, fn, *perShard):
+        # fn(conn, *args) on every shard at once, args holds that shard's part of each
+        futures = [
+            self.executor.submit(fn, conn, *args)
+            for conn, *args in zip(self.conns, *perShard)
+        ]
+        return [future.result() for future in futures]
+
+    def store(self, addresses, couples, bloomPath=BLOOM_PATH, stopAddresses=None):
+        addresses = np.asarray(addresses, dtype=np.int64)
+        couples = np.asarray(couples, dtype=np.int64)
+        shard = shardOf(addresses, len(self.dsns))
+        self.fanOut(
+            lambda conn, i: storeEncodedCouples(
+                conn,
+                addresses[shard == i],
+                couples[shard == i],
+                bloomPath=bloomPath,
+                stopAddresses=stopAddresses,
+            ),
+            range(len(self.dsns)),
+        )
+
+
+_shardPools = {}
+
+
+def getShardPool(dsns):
+    # One pool per process and shard list, None when the store is not sharded
+    if not dsns:
+        return None
+    key = tuple(dsns)
+    if key not in _shardPools:
+        _shardPools[key] = ShardPool(key)
+    return _shardPools[key]
@@ -0,0 +1,241 @@
+from dataclasses import asdict
+from hashlib import sha256
+from pathlib import Path
+import json
+import mmap
+import os
+import struct
+import tempfile
+import numpy as np
+import psycopg as sql
+
+from codec import CodecMismatch
+from constellation import configCodec, matchConfig
+from db_utils import (
+    readMetaRows,
+    readSortedCouples,
+    readSortedTones,
+    storeMetaRows,
+    storePostings,
+    storeTones,
+)
+
+SNAPSHOT_MAGIC = b"TONESNAP"
+SNAPSHOT_VERSION = 1
+# magic, version, address, couple and tone counts, name and meta bytes, padded to 72
+# bytes so every int64 section that follows is aligned
+HEADER = struct.Struct("<8sI4xQQQQQ16x")
+DIGEST_BYTES = 32
+CHUNK_BYTES = 1 << 24
+CHUNK_ADDRESSES = 1 << 16
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class HashingWriter:
+    # File writes that also feed the body checksum
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        self.f.write(data)
+
+
+def writeArray(out, values):
+    out.write(np.asarray(values, dtype="<i8").tobytes())
+
+
+def exportSnapshot(db, path):
+    """
+    Writes the catalog to one file: a header, every couple grouped by address in
+    address order, the sorted addresses, the offset of each address's couples, the
+    tones and the meta table, then a sha256 of all of it. Couples stream out of a
+    binary COPY and the address arrays are spooled to disk, so memory stays bounded
+    whatever the catalog size.
+    """
+    path = Path(path)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    digest = sha256()
+    numAddresses = numCouples = 0
+
+    with (
+        sql.connect(db) as conn,
+        open(tmp, "wb") as f,
+        tempfile.TemporaryFile() as addressSpool,
+        tempfile.TemporaryFile() as offsetSpool,
+    ):
+        # Couples, tones and meta all come from one snapshot of the database
+        conn.isolation_level = sql.IsolationLevel.REPEATABLE_READ
+        f.write(bytes(HEADER.size))
+        out = HashingWriter(f, digest)
+
+        last = None
+        for addresses, couples in readSortedCouples(conn):
+            writeArray(out, couples)
+            starts = np.flatnonzero(np.diff(addresses, prepend=addresses[0] - 1) != 0)
+            if last is not None and addresses[0] == last:
+                starts = starts[1:]
+            writeArray(addressSpool, addresses[starts])
+            writeArray(offsetSpool, starts + numCouples)
+            numAddresses += len(starts)
+            numCouples += len(couples)
+            last = addresses[-1]
+        writeArray(offsetSpool, [numCouples])
+
+        for spool in [addressSpool, offsetSpool]:
+            spool.seek(0)
+            while block := spool.read(CHUNK_BYTES):
+                out.write(block)
+
+        # The tone table is held in memory like caches.ToneCache does
+        tones = readSortedTones(conn)
+        names = [name.encode() for _, name in tones]
+        writeArray(out, [toneId for toneId, _ in tones])
+        writeArray(out, np.cumsum([0] + [len(name) for name in names]))
+        out.write(b"".join(names))
+        meta = json.dumps(readMetaRows(conn), sort_keys=True).encode()
+        out.write(meta)
+
+        header = HEADER.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            numAddresses,
+            numCouples,
+            len(tones),
+            sum(len(name) for name in names),
+            len(meta),
+        )
+        digest.update(header)
+        f.write(digest.digest())
+        f.seek(0)
+        f.write(header)
+
+    os.replace(tmp, path)
+    return numAddresses, numCouples, len(tones)
+
+
+class Snapshot:
+    """
+    Read-only view of an exported snapshot through mmap. The arrays are slices of
+    the mapped file, so opening is instant and the page cache holds what searches
+    touch. Has the name method of caches.ToneCache, so it can rank matches.
+    """
+
+    def __init__(self, path, verify=True):
+        self.path = str(path)
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mmap) < HEADER.size + DIGEST_BYTES:
+            raise SnapshotError(f"{path} is too short to be a snapshot")
+        magic, version, numAddresses, numCouples, numTones, nameBytes, metaBytes = (
+            HEADER.unpack_from(self.mmap)
+        )
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+        bodyBytes = 8 * (numCouples + 2 * numAddresses + 2 * numTones + 2)
+        bodyBytes += nameBytes + metaBytes
+        if HEADER.size + bodyBytes + DIGEST_BYTES != len(self.mmap):
+            raise SnapshotError(f"{path} is truncated or has trailing data")
+        if verify:
+            self.verify()
+
+        offset = HEADER.size
+        self.couples, offset = self._array(offset, numCouples)
+        self.addresses, offset = self._array(offset, numAddresses)
+        self.offsets, offset = self._array(offset, numAddresses + 1)
+        self.toneIds, offset = self._array(offset, numTones)
+        self.nameOffsets, offset = self._array(offset, numTones + 1)
+        self.names = memoryview(self.mmap)[offset : offset + nameBytes]
+        offset += nameBytes
+        self.meta = json.loads(bytes(self.mmap[offset : offset + metaBytes]))
+
+    def _array(self, offset, count):
+        array = np.frombuffer(self.mmap, dtype="<i8", count=count, offset=offset)
+        return array, offset + 8 * count
+
+    def verify(self):
+        end = len(self.mmap) - DIGEST_BYTES
+        digest = sha256()
+        for start in range(HEADER.size, end, CHUNK_BYTES):
+            digest.update(self.mmap[start : min(start + CHUNK_BYTES, end)])
+        digest.update(self.mmap[: HEADER.size])
+        if digest.digest() != self.mmap[end:]:
+            raise SnapshotError(f"{self.path} fails its checksum")
+
+    @property
+    def digest(self):
+        return self.mmap[-DIGEST_BYTES:].hex()
+
+    def checkConfig(self, config):
+        # Same checks as db_utils.checkConfig, against the exported meta table
+        codec = configCodec(config)
+        found = self.meta.get("codec")
+        if found is not None and json.loads(found) != asdict(codec):
+            raise CodecMismatch(
+                f"Snapshot uses codec {json.loads(found)['version']}, not {codec.version}"
+            )
+        matchConfig(self.meta.get("config"), config, "Snapshot")
+
+    def postings(self, addresses, cap=None):
+        # address -> at most cap couples, for the addresses the snapshot has
+        if len(self.addresses) == 0:
+            return {}
+        addresses = np.asarray(addresses, dtype=np.int64)
+        pos = np.searchsorted(self.addresses, addresses)
+        pos = np.minimum(pos, len(self.addresses) - 1)
+        hit = self.addresses[pos] == addresses
+        starts = self.offsets[pos[hit]]
+        ends = self.offsets[pos[hit] + 1]
+        if cap is not None:
+            ends = np.minimum(ends, starts + cap)
+        return {
+            address: self.couples[start:end]
+            for address, start, end in zip(
+                addresses[hit].tolist(), starts.tolist(), ends.tolist()
+            )
+        }
+
+    def iterPostings(self):
+        for first in range(0, len(self.addresses), CHUNK_ADDRESSES):
+            last = first + CHUNK_ADDRESSES
+            offsets = self.offsets[first : last + 1].tolist()
+            for i, address in enumerate(self.addresses[first:last].tolist()):
+                yield address, self.couples[offsets[i] : offsets[i + 1]]
+
+    def iterTones(self):
+        for i, toneId in enumerate(self.toneIds.tolist()):
+            yield toneId, self.name(toneId, i)
+
+    def name(self, toneId, pos=None):
+        if pos is None:
+            pos = np.searchsorted(self.toneIds, int(toneId))
+            if pos == len(self.toneIds) or self.toneIds[pos] != int(toneId):
+                return None
+        start, end = self.nameOffsets[pos], self.nameOffsets[pos + 1]
+        return bytes(self.names[start:end]).decode()
+
+
+_snapshots = {}
+
+
+def getSnapshot(path):
+    # Mapped and verified once per process, None when no snapshot is served
+    if path is None:
+        return None
+    if path not in _snapshots:
+        _snapshots[path] = Snapshot(path)
+    return _snapshots[path]
+
+
+def importSnapshot(db, snapshot):
+    # COPYs a snapshot into empty tables, couples go straight into packed postings
+    with sql.connect(db) as conn:
+        stored = storePostings(conn, snapshot.iterPostings())
+        storeTones(conn, snapshot.iterTones())
+        storeMetaRows(conn, snapshot.meta)
+    return stored
@@ -0,0 +1,137 @@
+from dataclasses import dataclass, field
+from hashlib import sha256
+import numpy as np
+import psycopg as sql
+
+from db_utils import (
+    readPostingListStats,
+    readStopAddresses,
+    readStopList,
+    reserveStopCouples,
+    storeStopAddresses,
+)
+
+# Addresses shared by more than STOP_MAX_DF songs carry almost no information
+STOP_MAX_DF = 500
+# Couples fetched per stop address under the cap policy
+STOP_CAP = 2000
+STOP_ACTIONS = ["skip", "cap", "downweight"]
+
+
+@dataclass
+class StopPolicy:
+    """
+    What to do with addresses in the stop_address table: skip them, fetch at most
+    cap couples, or fetch them whole and weigh each hit by maxDf / df.
+    """
+
+    action: str = "skip"
+    maxDf: int = STOP_MAX_DF
+    cap: int = STOP_CAP
+    dfs: dict = field(default_factory=dict)
+    digest: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.digest = sha256(repr(sorted(self.dfs.items())).encode()).hexdigest()
+
+    def identity(self):
+        # What search results depend on, the df table by its digest
+        return (self.action, self.maxDf, self.cap, self.digest)
+
+    def weight(self, address):
+        if self.action != "downweight" or address not in self.dfs:
+            return 1
+        return self.maxDf / self.dfs[address]
+
+
+def loadStopPolicy(db, action=None, cap=None):
+    # action and cap default to what the stop list was built with, maxDf is always
+    # the one it was built with so downweighting matches the list. None when there
+    # is no stop list and no action
+    if action is not None and action not in STOP_ACTIONS:
+        raise ValueError(f"Unknown stop word action: {action}")
+    with sql.connect(db) as conn:
+        built = readStopList(conn)
+        if built is None and action is None:
+            return None
+        dfs = {address: df for address, df in readStopAddresses(conn)}
+    built = built or {}
+    return StopPolicy(
+        action or built["action"],
+        built.get("maxDf") or STOP_MAX_DF,
+        cap or built.get("cap") or STOP_CAP,
+        dfs,
+    )
+
+
+def splitStopAddresses(addresses, stopPolicy, stats=None):
+    # Returns the addresses to fetch whole and the ones to fetch capped
+    if stopPolicy is None or not stopPolicy.dfs:
+        return addresses, []
+
+    stops = [address for address in addresses if address in stopPolicy.dfs]
+    if stats is not None:
+        stats["stopAddresses"] = stats.get("stopAddresses", 0) + len(stops)
+    match stopPolicy.action:
+        case "skip":
+            return [a for a in addresses if a not in stopPolicy.dfs], []
+        case "cap":
+            return [a for a in addresses if a not in stopPolicy.dfs], stops
+        case _:
+            return addresses, []
+
+
+def buildStopAddresses(db, maxDf=STOP_MAX_DF, action="skip", cap=STOP_CAP):
+    if action not in STOP_ACTIONS:
+        raise ValueError(f"Unknown stop word action: {action}")
+    with sql.connect(db) as conn:
+        return storeStopAddresses(conn, maxDf, action, cap)
+
+
+def capStopCouples(conn, addresses, couples, stopPolicy):
+    # Ingest side of cap and downweight: stop addresses grow by at most cap couples
+    # in total under cap, and stop_address counts the new tone so dfs stay current
+    addresses = np.asarray(addresses, dtype=np.int64)
+    couples = np.asarray(couples, dtype=np.int64)
+    stops, counts = np.unique(
+        addresses[np.isin(addresses, list(stopPolicy.dfs))], return_counts=True
+    )
+    if len(stops) == 0:
+        return addresses, couples
+
+    cap = stopPolicy.cap if stopPolicy.action == "cap" else None
+    allowed = reserveStopCouples(conn, dict(zip(stops.tolist(), counts.tolist())), cap)
+    keep = np.ones(len(addresses), dtype=bool)
+    for address, n in allowed.items():
+        keep[np.flatnonzero(addresses == address)[n:]] = False
+    return addresses[keep], couples[keep]
+
+
+def postingListStats(db, maxDf=STOP_MAX_DF):
+    with sql.connect(db) as conn:
+        (
+            addresses,
+            postings,
+            maxSeen,
+            percentiles,
+            above,
+            packedRows,
+            packedBytes,
+            appendBytes,
+            postingBytes,
+        ) = readPostingListStats(conn, maxDf)
+    p50, p90, p99, p999 = percentiles or (0, 0, 0, 0)
+    return {
+        "addresses": addresses,
+        "postings": int(postings),
+        "dfP50": p50,
+        "dfP90": p90,
+        "dfP99": p99,
+        "dfP999": p999,
+        "dfMax": maxSeen,
+        "aboveMaxDf": above,
+        "packedAddresses": packedRows,
+        "packedBytes": int(packedBytes),
+        "appendTableBytes": appendBytes,
+        "postingTableBytes": postingBytes,
+    }
@@ -0,0 +1,318 @@
+from dataclasses import dataclass
+import time
+import numpy as np
+import psycopg as sql
+import pyaudio
+from scipy.signal import butter, get_window, lfilter
+
+from audio_proc import LOWPASS_HZ, quantizeFreq9Bit
+from audio_utils import (
+    extractFrequencies,
+    generateTimeFreqOrderRelation,
+    getAudioInfo,
+)
+from caches import getToneCache
+from constellation import DEFAULT_CONFIG, configCodec, isConstellation
+from db_utils import checkConfig
+from shards import checkShards, getShardPool
+from scoring import DELTA_BIN_MS, OffsetHistogram, isConfident
+from search_load import (
+    MIN_HITS,
+    COHERENCY_COEFF,
+    CONFIDENCE_MARGIN,
+    lookupAddresses,
+    stopWeight,
+)
+
+CHUNK_MS = 100
+# Band edges in extractFrequencies are clamped by the frame count, catalog songs
+# have far more than 512 frames so streamed frames use the unclamped bands
+EXTRACT_BINS = 512
+
+
+@dataclass
+class StreamMatch:
+    tone: str
+    songId: int
+    coherency: int
+    streamMs: int
+    latencyMs: float
+
+
+class StreamFingerprinter:
+    """
+    Incremental version of processAudiofile over 16-bit PCM for the bands picker.
+    Window size, decimation and band layout come from config. Only the samples
+    that complete new STFT frames are transformed, and fingerprint returns the
+    address couples those frames complete with anchor times from the start of the
+    stream, so chunk edges neither lose nor add fingerprints.
+    """
+
+    def __init__(self, sampleFreq, config=None):
+        config = config or DEFAULT_CONFIG
+        if isConstellation(config):
+            raise ValueError("Streaming recognition only supports the bands picker")
+        self.config = config
+
+        # Same filter and decimation as preprocess, carried across chunks
+        self.factor = config.downsampleFactor
+        self.b, self.a = butter(4, LOWPASS_HZ / (0.5 * sampleFreq), btype="low")
+        self.zi = np.zeros(max(len(self.a), len(self.b)) - 1)
+        self.pending = np.zeros(0, dtype=np.int16)
+        self.seen = 0
+
+        # Same window arithmetic as processAudiofile/generateSpectograph
+        self.sampleFreq = sampleFreq // self.factor
+        windowDuration = int(self.sampleFreq / config.targetRes) / self.sampleFreq
+        self.windowSize = int(windowDuration * self.sampleFreq)
+        self.hop = self.windowSize - int(self.windowSize * 0.5)
+        self.window = get_window("hann", self.windowSize)
+        self.freq = np.array(
+            [
+                quantizeFreq9Bit(f)
+                for f in np.fft.rfftfreq(self.windowSize, 1 / self.sampleFreq)
+            ]
+        )
+        self.samples = np.zeros(0, dtype=np.int16)
+        self.consumed = 0
+
+        # generateAddress state: zone index, deque front and the peaks still needed
+        self.peaks = []
+        self.peakBase = 0
+        self.zoneIdx = 0
+        self.ptr = 0
+
+    @property
+    def streamMs(self):
+        return int(self.consumed / self.sampleFreq * 1000)
+
+    def _preprocess(self, chunk):
+        data = np.concatenate([self.pending, np.frombuffer(chunk, dtype=np.int16)])
+        # preprocess always downmixes (WAVInfo.mono is never set from the header),
+        # so consecutive sample pairs are averaged exactly like downmixToMono
+        even = len(data) - len(data) % 2
+        self.pending = data[even:]
+        data = (data[:even:2] + data[1:even:2]) // 2
+
+        if self.factor <= 1:
+            # downsample leaves the signal unfiltered when it does not decimate
+            return data
+
+        filtered, self.zi = lfilter(self.b, self.a, data, zi=self.zi)
+        filtered = np.clip(filtered, -32768, 32767).astype(np.int16)
+
+        start = -self.seen % self.factor
+        self.seen += len(filtered)
+        return filtered[start :: self.factor]
+
+    def _spectrogramColumns(self, samples):
+        self.samples = np.concatenate([self.samples, samples])
+        if len(self.samples) < self.windowSize:
+            return None, None
+
+        frames = (len(self.samples) - self.windowSize) // self.hop + 1
+        idx = np.arange(frames)[:, None] * self.hop + np.arange(self.windowSize)
+        segments = self.samples[idx].astype(np.float64) * self.window
+        Zxx = np.abs(np.fft.rfft(segments, axis=1)).T / self.window.sum()
+
+        starts = self.consumed + np.arange(frames) * self.hop
+        times = ((starts + self.windowSize / 2) / self.sampleFreq * 1000).astype(int)
+
+        self.samples = self.samples[frames * self.hop :]
+        self.consumed += frames * self.hop
+        return Zxx, times
+
+    def _newPeaks(self, Zxx, times):
+        strongest = extractFrequencies(
+            Zxx,
+            self.freq,
+            coef=self.config.bandCoef,
+            nBins=EXTRACT_BINS,
+            edges=self.config.bandEdges,
+        )
+        t = [
+            (freq, times[timeIdx])
+            for timeIdx, freqComp in enumerate(strongest)
+            for freq in freqComp
+            if freq > 0
+        ]
+        if not t:
+            return []
+
+        # Pairs are only ever reordered within a frame, two sentinel times keep the
+        # end-of-data rule in generateTimeFreqOrderRelation from touching the last frame
+        peakTimes = [peakTime for _, peakTime in t] + [-1, -2]
+        ordered = generateTimeFreqOrderRelation(peakTimes, [f for f, _ in t] + [0, 0])
+        return list(zip(list(ordered.values())[:-2], peakTimes[:-2]))
+
+    def _peak(self, i):
+        return self.peaks[i - self.peakBase]
+
+    def _advanceZones(self):
+        # Replays generateAddress, stopping whenever it would need peaks not yet heard
+        addressCouple = []
+        n = self.peakBase + len(self.peaks)
+        while self.zoneIdx + 4 < n:
+            target = self._peak(self.zoneIdx)[0]
+            p = self.ptr
+            while p < n and self._peak(p)[0] != target:
+                p += 1
+            self.ptr = p
+            if p + 4 >= n:
+                break
+
+            anchor, anchorTime = self._peak(0 if self.zoneIdx < 3 else self.zoneIdx - 3)
+            for k in range(5):
+                freq, freqTime = self._peak(p + k)
+                address = (anchor, freq, np.abs(anchorTime - freqTime))
+                addressCouple.append((address, (anchorTime, 0)))
+            self.ptr = p + 5
+            self.zoneIdx += 1
+
+        if self.zoneIdx >= 3:
+            keep = min(self.zoneIdx - 3, self.ptr)
+            self.peaks = self.peaks[keep - self.peakBase :]
+            self.peakBase = keep
+        return addressCouple
+
+    def fingerprint(self, chunk):
+        Zxx, times = self._spectrogramColumns(self._preprocess(chunk))
+        if Zxx is None:
+            return []
+        self.peaks += self._newPeaks(Zxx, times)
+        return self._advanceZones()
+
+    def flush(self):
+        # The last zones need peaks past the end of the stream
+        return []
+
+
+class StreamRecognizer:
+    """
+    Incremental version of processAudiofile + searchFileProgressive over 16-bit PCM.
+    config has to use the bands picker and match the database. Only the
+    fingerprints each chunk completes are looked up, and the offset histogram
+    carries over between chunks. feed returns a StreamMatch once the leader is
+    confident.
+    """
+
+    def __init__(
+        self,
+        db,
+        sampleFreq,
+        config=None,
+        coeff=COHERENCY_COEFF,
+        margin=CONFIDENCE_MARGIN,
+        minHits=MIN_HITS,
+        deltaBin=DELTA_BIN_MS,
+        bloom=None,
+        cache=None,
+        stopPolicy=None,
+        shards=None,
+    ):
+        config = config or DEFAULT_CONFIG
+        self.fingerprinter = StreamFingerprinter(sampleFreq, config)
+        self.db = db
+        self.conn = sql.connect(db)
+        checkConfig(self.conn, config)
+        checkShards(self.conn, shards)
+        self.shards = getShardPool(shards)
+        self.codec = configCodec(config)
+        self.coeff = coeff
+        self.margin = margin
+        self.minHits = minHits
+        self.bloom = bloom
+        self.cache = cache
+        self.stopPolicy = stopPolicy
+
+        self.histogram = OffsetHistogram(deltaBin)
+        self.reads = {}
+        self.numTargetZones = 0
+        self.match = None
+
+    def close(self):
+        self.conn.close()
+
+    def feed(self, chunk, arrival=None):
+        arrival = time.perf_counter() if arrival is None else arrival
+        if self.match is not None:
+            return self.match
+
+        addressCouple = self.fingerprinter.fingerprint(chunk)
+        if not addressCouple:
+            return None
+        self.numTargetZones += len(addressCouple)
+
+        encoded = [self.codec.encodeAddress(address) for address, _ in addressCouple]
+        self.reads.update(
+            lookupAddresses(
+                self.conn,
+                [a for a in encoded if a not in self.reads],
+                bloom=self.bloom,
+                cache=self.cache,
+                stopPolicy=self.stopPolicy,
+                shards=self.shards,
+            )
+        )
+        for address, (_, couple) in zip(encoded, addressCouple):
+            self.histogram.add(
+                couple[0],
+                self.reads[address],
+                weight=stopWeight(self.stopPolicy, address),
+            )
+
+        leaders = self.histogram.leaders(2, minHits=self.minHits)
+        if isConfident(
+            leaders, self.numTargetZones, self.coeff, self.margin, minHits=self.minHits
+        ):
+            songId, coherency = leaders[0]
+            self.match = StreamMatch(
+                tone=getToneCache(self.db).name(songId),
+                songId=songId,
+                coherency=coherency,
+                streamMs=self.fingerprinter.streamMs,
+                latencyMs=(time.perf_counter() - arrival) * 1000,
+            )
+        return self.match
+
+
+def recognizeFileStreaming(db, filename, chunkMs=CHUNK_MS, **kwargs):
+    info = getAudioInfo(filename)
+    recognizer = StreamRecognizer(db, info.sampleFreq, **kwargs)
+    chunkSize = info.bytesSec * chunkMs // 1000
+    chunkSize -= chunkSize % 2
+    try:
+        for pos in range(0, len(info.data), chunkSize):
+            match = recognizer.feed(info.data[pos : pos + chunkSize])
+            if match is not None:
+                return match
+        return None
+    finally:
+        recognizer.close()
+
+
+def recognizeMicrophone(
+    db, sampleFreq=44100, channels=2, chunkMs=CHUNK_MS, maxSeconds=30, **kwargs
+):
+    recognizer = StreamRecognizer(db, sampleFreq, **kwargs)
+    frames = sampleFreq * chunkMs // 1000
+    sound = pyaudio.PyAudio()
+    stream = sound.open(
+        format=pyaudio.paInt16,
+        channels=channels,
+        rate=sampleFreq,
+        input=True,
+        frames_per_buffer=frames,
+    )
+    print("Listening (CTRL-C to stop)")
+    try:
+        for _ in range(maxSeconds * 1000 // chunkMs):
+            match = recognizer.feed(stream.read(frames))
+            if match is not None:
+                return match
+        return None
+    except KeyboardInterrupt:
+        return None
+    finally:
+        stream.close()
+        recognizer.close()
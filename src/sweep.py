@@ -0,0 +1,269 @@
+from argparse import ArgumentParser
+from inspect import signature
+from itertools import product
+from pathlib import Path
+import json
+
+from bench import SCHEMA_PATH, SEARCHES, benchIngest, benchQueries, generateCorpus
+from constellation import FingerprintConfig
+from db_utils import createDatabase, createSchema, dropSchema
+from stopwords import (
+    STOP_ACTIONS,
+    buildStopAddresses,
+    loadStopPolicy,
+    postingListStats,
+)
+
+# Fingerprint settings need their own index, search settings reuse it
+FINGERPRINT_GRID = {
+    "targetRes": [100, 200],
+    "downsampleFactor": [2, 4],
+    "bandCoef": [0.3, 0.5],
+}
+# Every search mode takes its own keywords, and coeff is an absolute coherency for
+# search but a fraction of the target zones for the others
+SEARCH_GRIDS = {
+    "search": {
+        "coeff": [5, 10],
+        "timeFreqTol": [(0.5, 0.5)],
+        "coherencyTol": [1.0, 2.5],
+    },
+    "search_sql": {
+        "coeff": [0.3, 0.5],
+        "deltaBin": [10, 20],
+    },
+    "search_progressive": {
+        "coeff": [0.3, 0.5],
+        "margin": [1.5, 2.0],
+    },
+}
+# Stop lists trade recall for index size, every sweep also has a point without one
+STOP_GRID = {
+    "action": STOP_ACTIONS,
+    "maxDf": [5, 10],
+}
+SWEEP_TONES = 50
+SWEEP_QUERIES = 30
+
+
+def gridPoints(grid):
+    # JSON has no tuples, list values such as bandEdges become tuples
+    values = [
+        [tuple(v) if isinstance(v, list) else v for v in options]
+        for options in grid.values()
+    ]
+    return [dict(zip(grid, point)) for point in product(*values)]
+
+
+def checkSearchGrid(searchGrid, mode):
+    # Fails before any index is built rather than on the first query
+    accepted = signature(SEARCHES[mode]).parameters
+    unknown = [key for key in searchGrid if key not in accepted]
+    if unknown:
+        raise ValueError(f"{mode} does not take {', '.join(unknown)}")
+
+
+def dominates(a, b):
+    # Smaller is better for every metric
+    a = (-a["recallAt1"], a["latencyP50Ms"], a["indexBytes"])
+    b = (-b["recallAt1"], b["latencyP50Ms"], b["indexBytes"])
+    return all(x <= y for x, y in zip(a, b)) and a != b
+
+
+def paretoFront(points):
+    # Points no other point beats on recall, latency and index size at once
+    return [p for p in points if not any(dominates(q, p) for q in points)]
+
+
+def sweepConfig(db, schema, fields, tones, queries, searchGrid, mode, bloomPath):
+    config = FingerprintConfig(**fields)
+    pointDb = createSchema(db, schema)
+    try:
+        createDatabase(pointDb, SCHEMA_PATH)
+        ingest = benchIngest(pointDb, tones, bloomPath, config)
+        stats = postingListStats(pointDb)
+
+        points = []
+        for params in gridPoints(searchGrid):
+            res = benchQueries(pointDb, queries, [mode], config, **params)[mode]
+            points.append(
+                {
+                    "fingerprint": fields,
+                    "search": params,
+                    "recallAt1": res["accuracy"],
+                    "latencyP50Ms": res["latencyMs"].get("p50", 0),
+                    "latencyP90Ms": res["latencyMs"].get("p90", 0),
+                    "indexBytes": stats["appendTableBytes"]
+                    + stats["postingTableBytes"],
+                    "fingerprints": ingest["fingerprints"],
+                    "filesPerSecond": ingest["filesPerSecond"],
+                }
+            )
+        return points
+    finally:
+        dropSchema(db, schema)
+        Path(bloomPath).unlink(missing_ok=True)
+
+
+def sweepStopList(db, schema, stop, tones, queries, mode, bloomPath):
+    # Half the catalog is loaded before the stop list is built and half after, so
+    # its action applies on ingest as well as on search
+    pointDb = createSchema(db, schema)
+    try:
+        createDatabase(pointDb, SCHEMA_PATH)
+        half = len(tones) // 2
+        benchIngest(pointDb, tones[:half], bloomPath)
+        stopPolicy = None
+        if stop["action"] != "none":
+            buildStopAddresses(pointDb, stop["maxDf"], stop["action"])
+            stopPolicy = loadStopPolicy(pointDb)
+        ingest = benchIngest(pointDb, tones[half:], bloomPath, stopPolicy=stopPolicy)
+        stats = postingListStats(pointDb)
+
+        res = benchQueries(pointDb, queries, [mode], stopPolicy=stopPolicy)[mode]
+        return {
+            "stop": stop,
+            "recallAt1": res["accuracy"],
+            "latencyP50Ms": res["latencyMs"].get("p50", 0),
+            "latencyP90Ms": res["latencyMs"].get("p90", 0),
+            "indexBytes": stats["appendTableBytes"] + stats["postingTableBytes"],
+            "fingerprints": stats["postings"],
+            "filesPerSecond": ingest["filesPerSecond"],
+        }
+    finally:
+        dropSchema(db, schema)
+        Path(bloomPath).unlink(missing_ok=True)
+
+
+def runStopSweep(
+    db,
+    folder: Path,
+    stopGrid=STOP_GRID,
+    mode="search",
+    numTones=SWEEP_TONES,
+    numQueries=SWEEP_QUERIES,
+    seed=0,
+):
+    tones, queries = generateCorpus(folder, numTones, numQueries, seed)
+
+    points = []
+    for i, stop in enumerate([{"action": "none"}] + gridPoints(stopGrid)):
+        print(f"Indexing with stop list {stop}")
+        points.append(
+            sweepStopList(
+                db,
+                f"sweep_stop_{i}",
+                stop,
+                tones,
+                queries,
+                mode,
+                str(folder / f"sweep_stop_{i}.bloom"),
+            )
+        )
+    return points, paretoFront(points)
+
+
+def runSweep(
+    db,
+    folder: Path,
+    fingerprintGrid=FINGERPRINT_GRID,
+    searchGrid=None,
+    mode="search",
+    numTones=SWEEP_TONES,
+    numQueries=SWEEP_QUERIES,
+    seed=0,
+):
+    searchGrid = SEARCH_GRIDS[mode] if searchGrid is None else searchGrid
+    checkSearchGrid(searchGrid, mode)
+    tones, queries = generateCorpus(folder, numTones, numQueries, seed)
+
+    points = []
+    for i, fields in enumerate(gridPoints(fingerprintGrid)):
+        print(f"Indexing {fields}")
+        points += sweepConfig(
+            db,
+            f"sweep_{i}",
+            fields,
+            tones,
+            queries,
+            searchGrid,
+            mode,
+            str(folder / f"sweep_{i}.bloom"),
+        )
+    return points, paretoFront(points)
+
+
+def printPoints(points):
+    print(f"{'recall@1':>8} {'p50 ms':>8} {'index MB':>9} {'files/s':>8}  settings")
+    for p in sorted(points, key=lambda p: (-p["recallAt1"], p["latencyP50Ms"])):
+        settings = p["stop"] if "stop" in p else f"{p['fingerprint']} {p['search']}"
+        print(
+            f"{p['recallAt1']:8.2f} {p['latencyP50Ms']:8.1f} "
+            f"{p['indexBytes'] / 2**20:9.2f} {p['filesPerSecond']:8.2f}  {settings}"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        prog="sweep", description="Recall, latency and index size over a settings grid"
+    )
+    parser.add_argument(
+        "--db",
+        default="dbname=tones_bench user=mads",
+        help="Database the sweep creates and drops its sweep_N schemas in",
+    )
+    parser.add_argument("--corpus", default="bench_corpus", help="Corpus folder")
+    parser.add_argument("--output", default="sweep_results.json", help="Results file")
+    parser.add_argument(
+        "--grid",
+        default=None,
+        help='JSON file with "fingerprint", "search" and "stop" grids, FingerprintConfig '
+        "fields, search keyword arguments and stop list settings mapped to lists of "
+        "values",
+    )
+    parser.add_argument(
+        "--stop",
+        action="store_true",
+        help="Sweep stop list actions and maxDf instead of fingerprint and search settings",
+    )
+    parser.add_argument("--mode", default="search", choices=SEARCHES)
+    parser.add_argument("--tones", default=SWEEP_TONES, type=int)
+    parser.add_argument("--queries", default=SWEEP_QUERIES, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    fingerprintGrid, searchGrid, stopGrid = FINGERPRINT_GRID, None, STOP_GRID
+    if args.grid is not None:
+        with open(args.grid) as f:
+            grids = json.load(f)
+        fingerprintGrid = grids.get("fingerprint", fingerprintGrid)
+        searchGrid = grids.get("search", searchGrid)
+        stopGrid = grids.get("stop", stopGrid)
+
+    if args.stop:
+        points, front = runStopSweep(
+            args.db,
+            Path(args.corpus),
+            stopGrid,
+            args.mode,
+            args.tones,
+            args.queries,
+            args.seed,
+        )
+    else:
+        points, front = runSweep(
+            args.db,
+            Path(args.corpus),
+            fingerprintGrid,
+            searchGrid,
+            args.mode,
+            args.tones,
+            args.queries,
+            args.seed,
+        )
+    with open(args.output, "w") as f:
+        json.dump({"points": points, "pareto": front}, f, indent=2)
+
+    print("Pareto front:")
+    printPoints(front)
+    print(f"Wrote {len(points)} points to {args.output}")
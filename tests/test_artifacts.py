@@ -0,0 +1,47 @@
+from dataclasses import replace
+import numpy as np
+
+from artifacts import (
+    Artifact,
+    listArtifacts,
+    readArtifact,
+    writeArtifact,
+)
+from constellation import DEFAULT_CONFIG
+
+
+def testArtifactRoundTrip(tmp_path):
+    source = tmp_path / "tone.wav"
+    source.write_bytes(b"RIFF" + bytes(100))
+    rng = np.random.default_rng(0)
+    artifact = Artifact(
+        2**32 - 1,
+        "tōne.wav",
+        rng.integers(0, 2**40, 500),
+        rng.integers(0, 2**63 - 1, 500),
+    )
+    folder = tmp_path / "artifacts"
+    assert readArtifact(folder, source, DEFAULT_CONFIG) is None
+
+    writeArtifact(folder, source, DEFAULT_CONFIG, artifact)
+    read = readArtifact(folder, source, DEFAULT_CONFIG)
+    assert (read.toneId, read.name) == (artifact.toneId, artifact.name)
+    assert (read.addresses == artifact.addresses).all()
+    assert (read.couples == artifact.couples).all()
+    assert len(listArtifacts(folder, DEFAULT_CONFIG)) == 1
+    assert list(folder.rglob("*.tmp")) == []
+
+
+def testArtifactsAreKeyedOnSourceAndConfig(tmp_path):
+    source = tmp_path / "tone.wav"
+    source.write_bytes(b"a")
+    folder = tmp_path / "artifacts"
+    artifact = Artifact(1, "tone.wav", np.arange(3), np.arange(3))
+    writeArtifact(folder, source, DEFAULT_CONFIG, artifact)
+
+    other = replace(DEFAULT_CONFIG, fanOut=DEFAULT_CONFIG.fanOut + 1)
+    assert readArtifact(folder, source, other) is None
+    assert listArtifacts(folder, other) == []
+    source.write_bytes(b"b")
+    assert readArtifact(folder, source, DEFAULT_CONFIG) is None
+    assert readArtifact(None, source, DEFAULT_CONFIG) is None
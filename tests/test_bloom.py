@@ -0,0 +1,54 @@
+import os
+import numpy as np
+
+from bloom import BloomFilter, addToBloomFile, buildBloomFilter, getBloomFilter
+
+
+def testNoFalseNegatives():
+    rng = np.random.default_rng(0)
+    addresses = rng.integers(-(2**62), 2**62, 20000)
+    bloom = BloomFilter.sized(len(addresses), 0.01)
+    bloom.add(addresses)
+    assert bloom.contains(addresses).all()
+
+
+def testFalsePositiveRate():
+    rng = np.random.default_rng(1)
+    addresses = rng.integers(0, 2**40, 20000)
+    bloom = BloomFilter.sized(len(addresses), 0.01)
+    bloom.add(addresses)
+    others = np.setdiff1d(rng.integers(0, 2**40, 20000), addresses)
+    assert bloom.contains(others).mean() < 0.02
+
+
+def testSaveLoadRoundTrip(tmp_path):
+    path = str(tmp_path / "test.bloom")
+    addresses = np.arange(1000, dtype=np.int64) * 7919
+    bloom = buildBloomFilter(addresses, path)
+    loaded = getBloomFilter(path)
+    assert (loaded.numBits, loaded.numHashes, loaded.count) == (
+        bloom.numBits,
+        bloom.numHashes,
+        bloom.count,
+    )
+    assert loaded.contains(addresses).all()
+
+
+def testAddToBloomFileInPlace(tmp_path):
+    path = str(tmp_path / "test.bloom")
+    addresses = np.arange(1000, dtype=np.int64) * 7919
+    buildBloomFilter(addresses, path)
+    inode = os.stat(path).st_ino
+    before = getBloomFilter(path)
+
+    more = np.arange(1000, 1200, dtype=np.int64) * 7919
+    addToBloomFile(np.concatenate([more, more, addresses[:100]]), path)
+    assert os.stat(path).st_ino == inode
+    loaded = getBloomFilter(path)
+    assert loaded is not before
+    assert loaded.contains(np.concatenate([addresses, more])).all()
+    # Addresses already in the filter and repeats are not counted again
+    assert 1000 + 190 <= loaded.count <= 1200
+
+    addToBloomFile(more, path)
+    assert BloomFilter.load(path).count == loaded.count
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from caches import (
+    MISS,
+    POSTING_ENTRY_OVERHEAD,
+    PostingCache,
+    ResultCache,
+    VersionedCache,
+    resultKey,
+)
+
+
+def couples(n):
+    return np.arange(n, dtype=np.int64)
+
+
+def testPostingCacheEvictsLeastRecentlyUsed():
+    entry = 10 * 8 + POSTING_ENTRY_OVERHEAD
+    cache = PostingCache(maxBytes=3 * entry)
+    for address in [1, 2, 3]:
+        cache.put(address, couples(10))
+    assert cache.size == 3 * entry
+    cache.get(1)
+    cache.put(4, couples(10))
+    assert list(cache.entries) == [3, 1, 4]
+    assert cache.get(2) is None
+    assert cache.size == 3 * entry and cache.evictions == 1
+
+
+def testPostingCacheStaysWithinItsBytes():
+    cache = PostingCache(maxBytes=2000)
+    for address in range(50):
+        cache.put(address, couples(address))
+        assert cache.size <= 2000
+        assert cache.size == sum(
+            c.nbytes + POSTING_ENTRY_OVERHEAD for c in cache.entries.values()
+        )
+    # A list bigger than the whole cache is not stored and evicts nothing
+    before = list(cache.entries)
+    cache.put(99, couples(1000))
+    assert list(cache.entries) == before
+
+
+def testPostingCacheReplaceAndInvalidate():
+    cache = PostingCache(maxBytes=10_000)
+    cache.put(1, couples(10))
+    cache.put(1, couples(20))
+    cache.put(2, couples(5))
+    assert cache.size == 25 * 8 + 2 * POSTING_ENTRY_OVERHEAD
+    cache.invalidate([1, 3])
+    assert cache.get(1) is None
+    assert cache.size == 5 * 8 + POSTING_ENTRY_OVERHEAD
+    cache.checkVersion("a")
+    cache.checkVersion("b")
+    assert cache.get(2) is None and cache.size == 0
+    assert cache.stats()["hits"] == 0 and cache.stats()["misses"] == 2
+
+
+def testVersionedCacheNeedsClear():
+    with pytest.raises(TypeError):
+        VersionedCache()
+
+
+def testResultKeyDependsOnEveryInput():
+    keys = {
+        resultKey(b"a", "search", coeff=0.5),
+        resultKey(b"b", "search", coeff=0.5),
+        resultKey(b"a", "search_sql", coeff=0.5),
+        resultKey(b"a", "search", coeff=0.6),
+        resultKey(b"a", "search", coeff=0.5, topK=10),
+    }
+    assert len(keys) == 5
+
+
+def testResultKeyIgnoresParameterOrder():
+    assert resultKey(b"a", "search", coeff=0.5, topK=10) == resultKey(
+        b"a", "search", topK=10, coeff=0.5
+    )
+
+
+def testVersionChangeClearsResults():
+    cache = ResultCache()
+    cache.checkVersion((1, 2, "x"))
+    cache.put("key", None)
+    assert cache.get("key") is None
+    cache.checkVersion((1, 2, "x"))
+    assert cache.get("key") is None
+    cache.checkVersion((1, 2, "y"))
+    assert cache.get("key") is MISS
+
+
+def testExpiredResultsMiss():
+    cache = ResultCache(ttl=-1)
+    cache.put("key", 1)
+    assert cache.get("key") is MISS
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from codec import (
+    CODECS,
+    Codec,
+    decodeCouple64Bit,
+    encodeCouple64Bit,
+    packCouples,
+    unpackCouples,
+)
+
+
+def testPackUnpackRoundTrip():
+    couples = np.random.default_rng(0).integers(0, 2**63 - 1, 1000)
+    assert (unpackCouples(packCouples(couples)) == couples).all()
+
+
+def testPackUnpackEmpty():
+    assert len(unpackCouples(packCouples(np.zeros(0, dtype=np.int64)))) == 0
+
+
+@pytest.mark.parametrize("version", sorted(CODECS))
+def testAddressRoundTrip(version):
+    codec = CODECS[version]
+    rng = np.random.default_rng(version)
+    step = 1 << codec.freqShift
+    for _ in range(200):
+        address = (
+            int(rng.integers(0, 1 << codec.anchorBits)) * step,
+            int(rng.integers(0, 1 << codec.freqBits)) * step,
+            int(rng.integers(0, 1 << codec.deltaBits)) * codec.deltaStepMs,
+        )
+        assert codec.decodeAddress(codec.encodeAddress(address)) == address
+
+
+def testDeltaClampsInsteadOfWrapping():
+    codec = CODECS[1]
+    _, _, delta = codec.decodeAddress(codec.encodeAddress((1, 2, 1 << 20)))
+    assert delta == (1 << codec.deltaBits) - 1
+
+
+def testCodecMustFitBigint():
+    with pytest.raises(ValueError):
+        Codec(99, anchorBits=32, freqBits=32)
+
+
+def testCoupleRoundTrip():
+    couple = (123456, 2**32 - 1)
+    assert decodeCouple64Bit(encodeCouple64Bit(couple)) == couple
@@ -0,0 +1,32 @@
+from dataclasses import asdict
+import json
+import pytest
+
+from constellation import (
+    DEFAULT_CONFIG,
+    ConfigMismatch,
+    FingerprintConfig,
+    matchConfig,
+    pairPeaks,
+)
+
+
+def testMatchConfigAcceptsTheSameConfig():
+    matchConfig(json.dumps(asdict(DEFAULT_CONFIG)), None)
+    matchConfig(None, FingerprintConfig(fanOut=3))
+
+
+def testMatchConfigNamesTheDifferingFields():
+    stored = json.dumps(asdict(FingerprintConfig(fanOut=3, picker="constellation")))
+    with pytest.raises(ConfigMismatch, match="fanOut=3, picker=constellation"):
+        matchConfig(stored, FingerprintConfig(fanOut=5))
+
+
+def testPairPeaksStaysInTheTargetZone():
+    config = FingerprintConfig(zoneStartMs=10, zoneEndMs=100, zoneFreq=20, fanOut=2)
+    peaks = [(0, 100), (5, 105), (50, 110), (60, 200), (80, 115), (90, 118)]
+    pairs = pairPeaks(peaks, 7, config)
+    first = [(address, couple) for address, couple in pairs if couple[0] == 0]
+    # Too soon, too far in frequency, then the fan out is spent
+    assert first == [((100, 110, 50), (0, 7)), ((100, 115, 80), (0, 7))]
+    assert all(10 <= delta <= 100 for (_, _, delta), _ in pairs)
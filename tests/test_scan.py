@@ -0,0 +1,96 @@
+from dataclasses import replace
+import numpy as np
+import pytest
+
+from audio_proc import WAVInfo
+from audio_utils import processAudiofile
+from codec import encodeCouple64Bit
+from constellation import DEFAULT_CONFIG, configCodec
+import scan
+from scan import scoreBlock, streamFingerprinter, windowMatches
+
+SAMPLE_FREQ = 44100
+
+
+@pytest.fixture(scope="module")
+def recording():
+    # Stereo 16-bit PCM of short random tones over noise
+    rng = np.random.default_rng(0)
+    seconds = 14
+    t = np.arange(SAMPLE_FREQ * seconds) / SAMPLE_FREQ
+    signal = np.zeros((len(t), 2))
+    for _ in range(8 * seconds):
+        freq = rng.uniform(80, 4000)
+        start = rng.uniform(0, seconds - 0.5)
+        on = (t >= start) & (t < start + rng.uniform(0.1, 0.8))
+        signal[on, 0] += 3000 * np.sin(2 * np.pi * freq * t[on])
+        signal[on, 1] += 3000 * np.sin(2 * np.pi * freq * 1.01 * t[on])
+    signal += rng.normal(0, 200, signal.shape)
+    return np.clip(signal, -32768, 32767).astype(np.int16).reshape(-1).tobytes()
+
+
+def fingerprints(addressCouple):
+    return sorted(
+        (tuple(int(x) for x in address), int(couple[0]))
+        for address, couple in addressCouple
+    )
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        DEFAULT_CONFIG,
+        replace(DEFAULT_CONFIG, targetRes=100, downsampleFactor=2),
+        replace(DEFAULT_CONFIG, picker="constellation"),
+        replace(
+            DEFAULT_CONFIG, picker="constellation", downsampleFactor=3, targetRes=100
+        ),
+    ],
+)
+def testStreamedBlocksMatchTheWholeFile(recording, config):
+    info = WAVInfo(
+        sampleFreq=SAMPLE_FREQ,
+        bytesSec=SAMPLE_FREQ * 4,
+        blockAlign=4,
+        bitsPerSample=16,
+        data=recording,
+    )
+    whole = fingerprints(processAudiofile(info, None, 0, config=config))
+
+    fingerprinter = streamFingerprinter(SAMPLE_FREQ, 2, config)
+    streamed = []
+    block = SAMPLE_FREQ * 4 * 5
+    for start in range(0, len(recording), block):
+        streamed += fingerprinter.fingerprint(recording[start : start + block])
+    streamed = fingerprints(streamed + fingerprinter.flush())
+
+    assert streamed == whole
+
+
+def testWindowMatchesFindTheCoherentSong(monkeypatch):
+    # Song 5 is 2 s later in the catalog than in the recording, song 6 is scattered
+    codec = configCodec(None)
+    postings = {}
+
+    def lookupAddresses(conn, encoded, **kwargs):
+        return {address: postings[address] for address in encoded}
+
+    monkeypatch.setattr(scan, "lookupAddresses", lookupAddresses)
+    blocks = []
+    for block in range(2):
+        addressCouple = []
+        for i in range(30):
+            anchorTime = block * 5000 + i * 100
+            address = (i, block, 40)
+            postings[codec.encodeAddress(address)] = np.array(
+                [
+                    encodeCouple64Bit((anchorTime + 2000, 5)),
+                    encodeCouple64Bit((anchorTime * 3 + i, 6)),
+                ]
+            )
+            addressCouple.append((address, (anchorTime, 0)))
+        blocks.append(scoreBlock(None, addressCouple, 10))
+
+    assert windowMatches(blocks[:1], 20) == {5: (200, 30, 0, 2900)}
+    assert windowMatches(blocks, 20) == {5: (200, 60, 0, 7900)}
+    assert windowMatches(blocks, 61) == {}
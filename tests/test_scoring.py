@@ -0,0 +1,38 @@
+from codec import encodeCouple64Bit
+from scoring import OffsetHistogram, isConfident
+
+
+def couples(songId, times):
+    return [encodeCouple64Bit((t, songId)) for t in times]
+
+
+def testLeaderIsTheMostCoherentSong():
+    histogram = OffsetHistogram(deltaBin=10)
+    # Song 1 lines up at a 1000 ms offset, song 2 has more hits at scattered offsets
+    for anchorTime in [0, 100, 200, 300]:
+        histogram.add(anchorTime, couples(1, [anchorTime + 1000]))
+        histogram.add(anchorTime, couples(2, [anchorTime * 7 + 5, anchorTime * 3 + 9]))
+    assert histogram.leaders(2) == [(1, 4), (2, 2)]
+    assert histogram.hits[2] == 8
+
+
+def testLeadersRespectMinHits():
+    histogram = OffsetHistogram(deltaBin=10)
+    histogram.add(0, couples(1, [500]))
+    histogram.add(0, couples(2, [500, 700, 900]))
+    assert [songId for songId, _ in histogram.leaders(2, minHits=2)] == [2]
+
+
+def testWeightedHits():
+    histogram = OffsetHistogram(deltaBin=10)
+    histogram.add(0, couples(1, [500]), weight=0.5)
+    histogram.add(10, couples(1, [510]), weight=0.5)
+    assert histogram.leaders(1) == [(1, 1.0)]
+
+
+def testConfidence():
+    assert not isConfident([], 10, 0.5, 2.0)
+    assert isConfident([(1, 10), (2, 4)], 10, 0.5, 2.0)
+    # Beats the threshold but not the runner-up by the margin
+    assert not isConfident([(1, 10), (2, 6)], 10, 0.5, 2.0)
+    assert not isConfident([(1, 4)], 10, 0.5, 2.0)
@@ -0,0 +1,90 @@
+from contextlib import asynccontextmanager
+import asyncio
+import numpy as np
+import pytest
+
+pytest.importorskip("psycopg_pool")
+
+from caches import PostingCache
+import search_async
+from search_async import lookupAddressesAsync
+from stopwords import StopPolicy
+
+
+class FakePool:
+    def __init__(self):
+        self.connections = 0
+
+    @asynccontextmanager
+    async def connection(self):
+        self.connections += 1
+        yield self.connections
+
+
+@pytest.fixture
+def chunks(monkeypatch):
+    # Every address holds the couples address * 10 + 0..4, each pipelined chunk is logged
+    calls = []
+
+    async def readAddressCouplesPipelined(conn, addresses, cap=None):
+        calls.append((conn, list(addresses), cap))
+        n = 5 if cap is None else cap
+        return {a: [(a, a * 10 + i) for i in range(n)] for a in addresses}
+
+    monkeypatch.setattr(
+        search_async, "readAddressCouplesPipelined", readAddressCouplesPipelined
+    )
+    return calls
+
+
+def testChunksSpreadOverThePool(chunks):
+    pool = FakePool()
+    stats = {}
+    reads = asyncio.run(
+        lookupAddressesAsync(pool, list(range(10)) + [3, 3], poolSize=4, stats=stats)
+    )
+    assert sorted(reads) == list(range(10))
+    assert reads[7].tolist() == [70, 71, 72, 73, 74]
+    # Every address is read once, each slice on its own connection
+    assert sorted(a for _, chunk, _ in chunks for a in chunk) == list(range(10))
+    assert len(chunks) == 4 and pool.connections == 4
+    assert len({conn for conn, _, _ in chunks}) == 4
+    assert stats["lookups"] == 10
+
+
+def testNoEmptyChunks(chunks):
+    reads = asyncio.run(lookupAddressesAsync(FakePool(), [1, 2], poolSize=4))
+    assert len(chunks) == 2 and all(chunk for _, chunk, _ in chunks)
+    assert sorted(reads) == [1, 2]
+    assert asyncio.run(lookupAddressesAsync(FakePool(), [], poolSize=4)) == {}
+
+
+def testStopAddressesAreReadCapped(chunks):
+    policy = StopPolicy("cap", cap=2, dfs={1: 900, 2: 900})
+    reads = asyncio.run(
+        lookupAddressesAsync(FakePool(), range(6), poolSize=2, stopPolicy=policy)
+    )
+    assert sorted(a for _, chunk, cap in chunks if cap == 2 for a in chunk) == [1, 2]
+    assert sorted(a for _, chunk, cap in chunks if cap is None for a in chunk) == [
+        0,
+        3,
+        4,
+        5,
+    ]
+    assert reads[1].tolist() == [10, 11]
+    assert len(reads[0]) == 5
+
+
+def testCappedReadsStayOutOfThePostingCache(chunks):
+    cache = PostingCache(checkInterval=float("inf"))
+    policy = StopPolicy("cap", cap=2, dfs={1: 900})
+    asyncio.run(
+        lookupAddressesAsync(FakePool(), [0, 1], cache=cache, stopPolicy=policy)
+    )
+    assert list(cache.entries) == [0]
+
+    cache.put(1, np.arange(5, dtype=np.int64))
+    reads = asyncio.run(
+        lookupAddressesAsync(FakePool(), [0, 1], cache=cache, stopPolicy=policy)
+    )
+    assert reads[1].tolist() == [10, 11]
@@ -0,0 +1,185 @@
+from contextlib import nullcontext
+import numpy as np
+
+import search_load
+from artifacts import Artifact, writeArtifact
+from audio_proc import WAVInfo
+from caches import PostingCache
+from codec import DEFAULT_CODEC, encodeCouple64Bit
+from search_load import (
+    addMatches,
+    loadArtifacts,
+    lookupAddresses,
+    pruneCandidates,
+    searchFileProgressive,
+    searchKey,
+)
+from stopwords import StopPolicy
+
+
+def testAddMatchesCountsHitsAndMatchingZones():
+    foundTones, foundDB = {}, {}
+    couples = np.array(
+        [encodeCouple64Bit(c) for c in [(100, 7), (500, 7), (103, 8), (900, 9)]]
+    )
+    address = (1 << 23) | (2 << 14) | 30
+    addMatches(foundTones, foundDB, address, (101, 0), couples, (5, 0.5), weight=2)
+    assert list(foundTones) == [7, 8, 9]
+    assert foundTones[7] == {"common": 2, "hits": 4}
+    assert foundTones[8] == {"common": 2, "hits": 2}
+    assert foundTones[9] == {"common": 0, "hits": 2}
+    assert foundDB[7] == [((1, 2, 30), (100, 7))]
+
+
+def testPruneCandidatesKeepsTheTopK():
+    foundTones = {
+        id: {"common": 0, "hits": hits} for id, hits in enumerate([5, 1, 9, 3])
+    }
+    foundDB = {id: [id] for id in foundTones}
+    tones, db = pruneCandidates(foundTones, foundDB, topK=2, minHits=1)
+    assert list(tones) == [2, 0]
+    assert db == {2: [2], 0: [0]}
+
+    tones, _ = pruneCandidates(foundTones, foundDB, topK=10, minHits=4)
+    assert sorted(tones) == [0, 2]
+
+
+def testSearchKeyDependsOnWhereTheCatalogIsServedFrom(monkeypatch):
+    info = WAVInfo(data=b"pcm")
+    keys = {
+        searchKey("db", info, "search"),
+        searchKey("other", info, "search"),
+        searchKey("db", info, "search", shards=["a", "b"]),
+        searchKey("db", info, "search", shards=["b", "a"]),
+        searchKey("db", info, "search", stopPolicy=StopPolicy("skip")),
+        searchKey("db", info, "search", stopPolicy=StopPolicy("cap")),
+        searchKey("db", info, "search", stopPolicy=StopPolicy(dfs={1: 600})),
+    }
+    assert len(keys) == 7
+
+    class FakeSnapshot:
+        digest = "abc"
+
+    monkeypatch.setattr(search_load, "getSnapshot", lambda path: FakeSnapshot())
+    snapshotKey = searchKey("db", info, "search", snapshot="catalog.snap")
+    assert snapshotKey not in keys
+    FakeSnapshot.digest = "def"
+    assert searchKey("db", info, "search", snapshot="catalog.snap") != snapshotKey
+
+
+class FakeSnapshot:
+    # Every address holds one couple of tone 1, five seconds later than in the query
+    def __init__(self, anchorTimes):
+        self.anchorTimes = anchorTimes
+
+    def checkConfig(self, config):
+        pass
+
+    def postings(self, addresses, cap=None):
+        return {
+            a: np.array([encodeCouple64Bit((self.anchorTimes[a] + 5000, 1))])
+            for a in addresses
+        }
+
+    def name(self, toneId):
+        return f"tone {toneId}"
+
+
+class EvenBloom:
+    # Rules out every address with an odd anchor
+    def contains(self, addresses):
+        return np.array([DEFAULT_CODEC.decodeAddress(a)[0] % 2 == 0 for a in addresses])
+
+
+def testLookupsSavedOnlyCountsTheSlicesNeverRead(monkeypatch):
+    # 90 zones a tenth of a second apart, ten per one second slice
+    addressCouple = [((i, 100, 50), (i * 100, 0)) for i in range(90)]
+    monkeypatch.setattr(search_load, "decodeQuery", lambda *a, **k: WAVInfo())
+    monkeypatch.setattr(search_load, "fingerprintQuery", lambda *a, **k: addressCouple)
+    anchorTimes = {
+        DEFAULT_CODEC.encodeAddress(address): couple[0]
+        for address, couple in addressCouple
+    }
+    catalog = FakeSnapshot(anchorTimes)
+    monkeypatch.setattr(search_load, "openCatalog", lambda *a: nullcontext())
+    monkeypatch.setattr(search_load, "getToneCache", lambda db: catalog)
+    monkeypatch.setattr(
+        search_load,
+        "fetchPostings",
+        lambda conn, addresses, *a: (
+            [(a, c) for a, p in catalog.postings(addresses).items() for c in p],
+            {},
+        ),
+    )
+
+    stats = {}
+    res = searchFileProgressive("db", "query.wav", bloom=EvenBloom(), stats=stats)
+    assert res == "tone 1"
+    # Confident after the first slice, half of which the bloom filter skipped
+    assert stats["totalLookups"] == 90
+    assert stats["skipped"] == 5 and stats["lookups"] == 5
+    assert stats["lookupsSaved"] == 80
+
+
+def testCappedReadsStayOutOfThePostingCache(monkeypatch):
+    fetches = []
+
+    def fetchPostings(conn, addresses, capped=(), cap=None):
+        fetches.append((sorted(addresses), sorted(capped), cap))
+        rows = [(a, a * 10 + i) for a in addresses for i in range(5)]
+        rows += [(a, a * 10 + i) for a in capped for i in range(cap)]
+        return rows, {}
+
+    monkeypatch.setattr(search_load, "fetchPostings", fetchPostings)
+    cache = PostingCache(checkInterval=float("inf"))
+    policy = StopPolicy("cap", cap=2, dfs={1: 900})
+
+    reads = lookupAddresses(None, [0, 1], cache=cache, stopPolicy=policy)
+    assert reads[1].tolist() == [10, 11]
+    assert list(cache.entries) == [0]
+
+    # Without the policy the full list is read, and a full list in the cache is not
+    # served for a capped address
+    assert len(lookupAddresses(None, [1], cache=cache)[1]) == 5
+    reads = lookupAddresses(None, [0, 1], cache=cache, stopPolicy=policy)
+    assert reads[1].tolist() == [10, 11]
+    assert fetches[-1] == ([], [1], 2)
+
+
+def testRebuildStoresTheCachedFingerprints(monkeypatch, tmp_path):
+    artifacts = []
+    for i in range(3):
+        source = tmp_path / f"tone{i}.wav"
+        source.write_bytes(bytes([i]))
+        artifact = Artifact(i, source.name, np.arange(i, i + 4), np.arange(4) << 32)
+        writeArtifact(tmp_path / "artifacts", source, None, artifact)
+        artifacts.append(artifact)
+
+    stored = []
+
+    class FakeConnection:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    monkeypatch.setattr(search_load.sql, "connect", lambda db: FakeConnection())
+    monkeypatch.setattr(search_load, "checkConfig", lambda *a, **k: None)
+    monkeypatch.setattr(search_load, "checkShards", lambda *a, **k: None)
+    monkeypatch.setattr(
+        search_load, "storeArtifact", lambda conn, artifact, *a: stored.append(artifact)
+    )
+    assert loadArtifacts("db", tmp_path / "artifacts") == 3
+    stored.sort(key=lambda artifact: artifact.toneId)
+    for artifact, expected in zip(stored, artifacts):
+        assert (artifact.toneId, artifact.name) == (expected.toneId, expected.name)
+        assert (artifact.addresses == expected.addresses).all()
+        assert (artifact.couples == expected.couples).all()
+
+
+def testSnapshotLookupsIgnoreTheDatabaseBloomFilter():
+    addresses = [DEFAULT_CODEC.encodeAddress((i, 100, 50)) for i in range(4)]
+    snapshot = FakeSnapshot(dict.fromkeys(addresses, 0))
+    reads = lookupAddresses(None, addresses, bloom=EvenBloom(), snapshot=snapshot)
+    assert all(len(reads[address]) == 1 for address in addresses)
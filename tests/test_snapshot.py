@@ -0,0 +1,118 @@
+from dataclasses import asdict
+import json
+import numpy as np
+import pytest
+
+import snapshot
+from codec import CODECS, CodecMismatch
+from constellation import DEFAULT_CONFIG, ConfigMismatch, FingerprintConfig
+from snapshot import Snapshot, SnapshotError, exportSnapshot, importSnapshot
+
+TONES = [(3, "tone"), (7, "ĉhord"), (9, "x")]
+META = {
+    "codec": json.dumps(asdict(CODECS[1]), sort_keys=True),
+    "config": json.dumps(asdict(DEFAULT_CONFIG), sort_keys=True),
+}
+
+
+class FakeConnection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    # Sorted (address, couple) pairs served in uneven blocks, as a binary COPY would
+    rng = np.random.default_rng(0)
+    addresses = rng.integers(-50, 50, 5000)
+    couples = rng.integers(0, 2**40, 5000)
+    order = np.lexsort((couples, addresses))
+    addresses, couples = addresses[order], couples[order]
+
+    def readSortedCouples(conn):
+        for start in range(0, len(addresses), 777):
+            yield addresses[start : start + 777], couples[start : start + 777]
+
+    monkeypatch.setattr(snapshot.sql, "connect", lambda db: FakeConnection())
+    monkeypatch.setattr(snapshot, "readSortedCouples", readSortedCouples)
+    monkeypatch.setattr(snapshot, "readSortedTones", lambda conn: TONES)
+    monkeypatch.setattr(snapshot, "readMetaRows", lambda conn: META)
+    return addresses, couples
+
+
+def testExportRoundTrip(catalog, tmp_path):
+    addresses, couples = catalog
+    path = tmp_path / "catalog.snap"
+    assert exportSnapshot("db", path) == (len(np.unique(addresses)), 5000, 3)
+
+    snap = Snapshot(path)
+    assert (snap.addresses == np.unique(addresses)).all()
+    for address in [-50, 0, 49, 100]:
+        found = snap.postings([address])
+        expected = couples[addresses == address]
+        if len(expected):
+            assert (found[address] == expected).all()
+        else:
+            assert address not in found
+    assert (snap.postings([0], cap=2)[0] == couples[addresses == 0][:2]).all()
+    assert list(snap.iterTones()) == TONES
+    assert snap.name(8) is None
+    assert snap.meta == META
+
+
+def testImportWritesWhatWasExported(catalog, tmp_path, monkeypatch):
+    addresses, couples = catalog
+    path = tmp_path / "catalog.snap"
+    exportSnapshot("db", path)
+
+    stored = {}
+
+    def storePostings(conn, postings):
+        stored["postings"] = {address: list(c) for address, c in postings}
+        return len(stored["postings"])
+
+    monkeypatch.setattr(
+        snapshot, "storeTones", lambda conn, tones: stored.update(tones=list(tones))
+    )
+    monkeypatch.setattr(
+        snapshot, "storeMetaRows", lambda conn, meta: stored.update(meta=meta)
+    )
+    monkeypatch.setattr(snapshot, "storePostings", storePostings)
+
+    assert importSnapshot("db", Snapshot(path)) == len(np.unique(addresses))
+    assert sum(len(c) for c in stored["postings"].values()) == len(couples)
+    assert stored["postings"][0] == list(couples[addresses == 0])
+    assert stored["tones"] == TONES
+    assert stored["meta"] == META
+
+
+def testCorruptionIsCaught(catalog, tmp_path):
+    path = tmp_path / "catalog.snap"
+    exportSnapshot("db", path)
+    data = bytearray(path.read_bytes())
+    data[100] ^= 1
+    path.write_bytes(bytes(data))
+    with pytest.raises(SnapshotError, match="checksum"):
+        Snapshot(path)
+
+
+def testTruncationIsCaught(catalog, tmp_path):
+    path = tmp_path / "catalog.snap"
+    exportSnapshot("db", path)
+    path.write_bytes(path.read_bytes()[:-8])
+    with pytest.raises(SnapshotError, match="truncated"):
+        Snapshot(path)
+
+
+def testConfigIsChecked(catalog, tmp_path):
+    path = tmp_path / "catalog.snap"
+    exportSnapshot("db", path)
+    snap = Snapshot(path)
+    snap.checkConfig(DEFAULT_CONFIG)
+    with pytest.raises(CodecMismatch):
+        snap.checkConfig(FingerprintConfig(codec=2))
+    with pytest.raises(ConfigMismatch):
+        snap.checkConfig(FingerprintConfig(fanOut=DEFAULT_CONFIG.fanOut + 1))
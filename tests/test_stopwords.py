@@ -0,0 +1,61 @@
+import numpy as np
+
+import stopwords
+from stopwords import StopPolicy, capStopCouples, splitStopAddresses
+
+
+def testSplitStopAddresses():
+    addresses = [1, 2, 3, 4]
+    dfs = {2: 900, 4: 600}
+    assert splitStopAddresses(addresses, None) == (addresses, [])
+    assert splitStopAddresses(addresses, StopPolicy("skip", dfs=dfs)) == ([1, 3], [])
+    assert splitStopAddresses(addresses, StopPolicy("cap", dfs=dfs)) == ([1, 3], [2, 4])
+    assert splitStopAddresses(addresses, StopPolicy("downweight", dfs=dfs)) == (
+        addresses,
+        [],
+    )
+
+
+def testDownweightUsesMaxDf():
+    policy = StopPolicy("downweight", maxDf=500, dfs={2: 1000})
+    assert policy.weight(2) == 0.5
+    assert policy.weight(3) == 1
+    assert StopPolicy("skip", maxDf=500, dfs={2: 1000}).weight(2) == 1
+
+
+def testIdentityCoversTheDfTable():
+    identities = {
+        StopPolicy("cap").identity(),
+        StopPolicy("skip").identity(),
+        StopPolicy("cap", cap=10).identity(),
+        StopPolicy("cap", maxDf=10).identity(),
+        StopPolicy("cap", dfs={1: 600}).identity(),
+    }
+    assert len(identities) == 5
+    assert (
+        StopPolicy(dfs={1: 2, 3: 4}).identity()
+        == StopPolicy(dfs={3: 4, 1: 2}).identity()
+    )
+
+
+def testCapStopCouplesKeepsTheAllowance(monkeypatch):
+    requests = []
+
+    def reserveStopCouples(conn, counts, cap):
+        requests.append((counts, cap))
+        return {address: min(n, 1) for address, n in counts.items()}
+
+    monkeypatch.setattr(stopwords, "reserveStopCouples", reserveStopCouples)
+    policy = StopPolicy("cap", cap=1, dfs={5: 900, 7: 900})
+    addresses = np.array([1, 5, 5, 7, 2, 5, 7])
+    kept, couples = capStopCouples(None, addresses, np.arange(7), policy)
+    assert requests == [({5: 3, 7: 2}, 1)]
+    assert kept.tolist() == [1, 5, 7, 2]
+    assert couples.tolist() == [0, 1, 3, 4]
+
+
+def testCapStopCouplesWithoutStopAddresses(monkeypatch):
+    monkeypatch.setattr(stopwords, "reserveStopCouples", None)
+    policy = StopPolicy("downweight", dfs={5: 900})
+    kept, couples = capStopCouples(None, [1, 2], [10, 20], policy)
+    assert kept.tolist() == [1, 2] and couples.tolist() == [10, 20]
@@ -0,0 +1,37 @@
+import pytest
+
+from bench import SEARCHES
+from sweep import SEARCH_GRIDS, checkSearchGrid, dominates, gridPoints, paretoFront
+
+
+def point(recall, latency, size):
+    return {"recallAt1": recall, "latencyP50Ms": latency, "indexBytes": size}
+
+
+def testDominates():
+    assert dominates(point(0.9, 10, 100), point(0.8, 10, 100))
+    assert not dominates(point(0.9, 10, 100), point(0.9, 10, 100))
+    assert not dominates(point(0.9, 20, 100), point(0.8, 10, 100))
+
+
+def testParetoFront():
+    best = point(0.9, 10, 100)
+    small = point(0.7, 12, 50)
+    fast = point(0.8, 5, 120)
+    beaten = point(0.8, 11, 100)
+    assert paretoFront([best, small, fast, beaten]) == [best, small, fast]
+
+
+def testGridPoints():
+    points = gridPoints({"a": [1, 2], "b": [[0.5, 0.5]]})
+    assert points == [{"a": 1, "b": (0.5, 0.5)}, {"a": 2, "b": (0.5, 0.5)}]
+
+
+@pytest.mark.parametrize("mode", sorted(SEARCHES))
+def testEveryModeHasADefaultGridItAccepts(mode):
+    checkSearchGrid(SEARCH_GRIDS[mode], mode)
+
+
+def testUnknownSearchKeywordsFailEarly():
+    with pytest.raises(ValueError, match="search_sql does not take timeFreqTol"):
+        checkSearchGrid(SEARCH_GRIDS["search"], "search_sql")